@@ -0,0 +1,349 @@
+"""
+Loopback benchmark for the RTP sink and source.
+
+Streams a synthetic audio source through :class:`mopidy_rtp.sink.RtpSink`
+to N simulated subscribers, attached with
+:meth:`mopidy_rtp.actor.RtpBackend._start_rtp_session`, which receive the
+streams with :class:`mopidy_rtp.source.RTPSource` in a separate process
+on localhost.  For every codec and subscriber count it reports:
+
+* sender and receiver CPU time as a percentage of one core, and the
+  sender's CPU cost per subscriber over the zero subscriber baseline
+* packets/s and bytes/s sent per subscriber
+* glass-to-glass latency, from the capture of a tick in the synthetic
+  source on the sender to its rendering by a synchronised sink after the
+  decoder on the receiver, i.e., including the encoder, payloader, jitter
+  buffer, depayloader and decoder
+* packet loss, from gaps in the RTP sequence numbers received
+
+Usage::
+
+    python benchmarks/loopback.py --subscribers 0,1,2,4,8 --duration 10
+    python benchmarks/loopback.py --codec flacenc:flacdec --codec identity:identity
+    python benchmarks/loopback.py --payload l16
+
+The synthetic source is pink noise with a loud tick once a second, so
+the encoders see a realistic signal and latency can be measured from
+the ticks' onsets, assuming it is below one second.  Codecs default to
+the encoder and decoder in ``mopidy_rtp/ext.conf``, and are only used
+by the ``gst`` payload mode.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import array
+import bisect
+import ConfigParser
+import io
+import json
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pygst  # noqa
+pygst.require('0.10')
+import gst  # noqa
+import gobject  # noqa
+
+import mopidy_rtp  # noqa
+from mopidy_rtp import actor, payload, sink, source  # noqa
+
+HOST = '127.0.0.1'
+RATE = 44100
+CHANNELS = 2
+AUDIO_CAPS = ('audio/x-raw-int, endianness=(int)1234, signed=(boolean)true, '
+              'width=(int)16, depth=(int)16, rate=(int)%d, channels=(int)%d'
+              % (RATE, CHANNELS))
+# audiotestsrc ticks once a second; anything this loud is a tick, as the
+# noise is mixed in well below it
+NOISE_VOLUME = 0.1
+TICK_VOLUME = 0.8
+TICK_THRESHOLD = 16384
+
+
+def load_config():
+    """Returns the extension's default config, as Mopidy would load it"""
+    ext = mopidy_rtp.Extension()
+    parser = ConfigParser.RawConfigParser()
+    parser.readfp(io.BytesIO(ext.get_default_config().encode('utf-8')))
+    (result, errors) = ext.get_config_schema().deserialize(
+        dict(parser.items(ext.ext_name)))
+    if (errors):
+        raise SystemExit('Invalid ext.conf: %s' % errors)
+    return result
+
+
+def cpu_time(who=resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def rtp_seq(buf):
+    return struct.unpack(b'!H', buf.data[2:4])[0]
+
+
+class TickDetector(object):
+    """Records the wall clock times of the ticks' onsets in S16 audio"""
+
+    def __init__(self):
+        self.quiet = 0
+        self.onsets = []
+
+    def feed(self, data, start):
+        """Scans a buffer whose first sample is at wall clock time ``start``"""
+        samples = array.array(b'h', data)[::CHANNELS]
+        if (max(samples) < TICK_THRESHOLD and min(samples) > -TICK_THRESHOLD):
+            self.quiet += len(samples)
+            return
+        for (i, sample) in enumerate(samples):
+            if (abs(sample) < TICK_THRESHOLD):
+                self.quiet += 1
+                continue
+            if (self.quiet >= RATE // 2):
+                self.onsets.append(start + float(i) / RATE)
+            self.quiet = 0
+
+
+def latencies(sent, received):
+    """Pairs every received onset with the last onset sent before it"""
+    result = []
+    for t in received:
+        i = bisect.bisect_right(sent, t)
+        if (i and t - sent[i - 1] < 1.0):
+            result.append((t - sent[i - 1]) * 1000)
+    return result
+
+
+def run_loop(seconds):
+    loop = gobject.MainLoop()
+    gobject.timeout_add(int(seconds * 1000), loop.quit)
+    loop.run()
+
+
+def free_udp_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind((HOST, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def receive(args):
+    """Child process: receives ``args.receive`` streams and reports results"""
+    (encoder, decoder) = args.codec[0].split(':')
+    conf = load_config()
+    source.decoder = decoder
+    source.caps_string = conf['caps']
+    sockets = []
+    receivers = []
+    pipeline = gst.Pipeline()
+    for i in range(args.receive):
+        rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rtp.bind((HOST, 0))
+        rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rtcp.bind((HOST, 0))
+        sockets.append((rtp, rtcp))
+        uri = 'rtp://%d?sockfd=%d&rtcpfd=%d&rtcp=%s:%d&payload=%s' % (
+            rtp.getsockname()[1], rtp.fileno(), rtcp.fileno(), HOST, args.rtcp,
+            args.payload)
+        src = gst.element_factory_make('rtpsrc')
+        src.set_property('uri', uri)
+        conv = gst.element_factory_make('audioconvert')
+        resample = gst.element_factory_make('audioresample')
+        caps = gst.element_factory_make('capsfilter')
+        caps.set_property('caps', gst.Caps(AUDIO_CAPS))
+        fake = gst.element_factory_make('fakesink')
+        fake.set_property('sync', True)
+        fake.set_property('signal-handoffs', True)
+        pipeline.add(src, conv, resample, caps, fake)
+        gst.element_link_many(src, conv, resample, caps, fake)
+        r = {'port': rtp.getsockname()[1], 'ticks': TickDetector(), 'seqs': set()}
+        src.depay.get_pad('sink').add_buffer_probe(_on_receive, r)
+        fake.connect('handoff', _on_render, r)
+        receivers.append(r)
+    print(json.dumps([(r.getsockname()[1], c.getsockname()[1]) for (r, c) in sockets]))
+    sys.stdout.flush()
+    pipeline.set_state(gst.STATE_PLAYING)
+    run_loop(args.warmup)
+    for r in receivers:
+        r['ticks'].onsets = []
+        r['seqs'] = set()
+    start = cpu_time()
+    run_loop(args.duration)
+    cpu = cpu_time() - start
+    pipeline.set_state(gst.STATE_NULL)
+    results = []
+    for r in receivers:
+        seqs = sorted(r['seqs'])
+        expected = (seqs[-1] - seqs[0] + 1) if seqs else 0
+        results.append({'port': r['port'],
+                        'onsets': r['ticks'].onsets,
+                        'received': len(seqs),
+                        'expected': expected})
+    print(json.dumps({'cpu': cpu, 'receivers': results}))
+
+
+def _on_receive(pad, buf, r):
+    r['seqs'].add(rtp_seq(buf))
+    return True
+
+
+def _on_render(fake, buf, pad, r):
+    # The sink has waited for the buffer's first sample to be due, and
+    # both processes share the same wall clock on localhost
+    r['ticks'].feed(buf.data, time.time())
+
+
+def send(conf, encoder, decoder, subscribers, args):
+    """Runs one measurement, returning a dictionary of results"""
+    # The backend sets the sink's globals from its config, so
+    # override them afterwards
+    backend = actor.RtpBackend({'rtp': conf}, audio=None)
+    sink.encoder = encoder
+    sink.payload_mode = args.payload
+    sink.fanout = args.fanout or conf['fanout']
+    sink.rtcp_port = free_udp_port()
+    rtp_sink = sink.RtpSink()
+    backend.sink = rtp_sink
+    ticks = TickDetector()
+
+    def on_capture(pad, buf):
+        # A live source pushes a buffer once its last sample is captured
+        samples = len(buf.data) // (2 * CHANNELS)
+        ticks.feed(buf.data, time.time() - float(samples) / RATE)
+        return True
+
+    pipeline = gst.Pipeline()
+    noise = gst.element_factory_make('audiotestsrc')
+    noise.set_property('is-live', True)
+    noise.set_property('wave', 'pink-noise')
+    noise.set_property('volume', NOISE_VOLUME)
+    tick = gst.element_factory_make('audiotestsrc')
+    tick.set_property('is-live', True)
+    tick.set_property('wave', 'ticks')
+    tick.set_property('volume', TICK_VOLUME)
+    adder = gst.element_factory_make('adder')
+    caps = gst.element_factory_make('capsfilter')
+    caps.set_property('caps', gst.Caps(AUDIO_CAPS))
+    caps.get_pad('src').add_buffer_probe(on_capture)
+    pipeline.add(noise, tick, adder, caps, rtp_sink)
+    noise.link(adder)
+    tick.link(adder)
+    gst.element_link_many(adder, caps, rtp_sink)
+
+    child = None
+    if (subscribers):
+        child = subprocess.Popen(
+            [sys.executable, __file__, '--receive', str(subscribers),
+             '--rtcp', str(sink.rtcp_port), '--codec', '%s:%s' % (encoder, decoder),
+             '--payload', args.payload,
+             '--warmup', str(args.warmup), '--duration', str(args.duration)],
+            stdout=subprocess.PIPE)
+        ports = json.loads(child.stdout.readline())
+        for (port, rtcp) in ports:
+            backend._start_rtp_session(HOST, port, rtcp)
+    pipeline.set_state(gst.STATE_PLAYING)
+    run_loop(args.warmup)
+    start_counters = rtp_sink.get_counters()
+    start_cpu = cpu_time()
+    ticks.onsets = []
+    run_loop(args.duration)
+    cpu = cpu_time() - start_cpu
+    counters = rtp_sink.get_counters()
+    for (host, port) in backend.subscribers.keys():
+        backend._stop_rtp_session(host, port)
+    pipeline.set_state(gst.STATE_NULL)
+
+    result = {'payload': args.payload, 'encoder': encoder, 'decoder': decoder,
+              'subscribers': subscribers,
+              'sender_cpu': 100 * cpu / args.duration}
+    if (child):
+        received = json.loads(child.stdout.read())
+        child.wait()
+        result['receiver_cpu'] = 100 * received['cpu'] / args.duration
+        samples = []
+        lost = expected = 0
+        for r in received['receivers']:
+            samples.extend(latencies(ticks.onsets, r['onsets']))
+            lost += max(r['expected'] - r['received'], 0)
+            expected += r['expected']
+        samples.sort()
+        if (samples):
+            result['latency_ms'] = samples[len(samples) // 2]
+            result['latency_p95_ms'] = samples[int(len(samples) * 0.95)]
+        result['loss'] = float(lost) / expected if expected else 0.0
+        packets = bytes_ = 0
+        for key in counters:
+            if (key.startswith('subscriber.') and key.endswith('.packets_sent')):
+                packets += counters[key] - start_counters.get(key, 0)
+            elif (key.startswith('subscriber.') and key.endswith('.bytes_sent')):
+                bytes_ += counters[key] - start_counters.get(key, 0)
+        result['packets_per_s'] = packets / float(args.duration) / subscribers
+        result['bytes_per_s'] = bytes_ / float(args.duration) / subscribers
+    return result
+
+
+def report(results):
+    columns = ['payload', 'encoder', 'subscribers', 'sender_cpu', 'cpu_per_subscriber',
+               'receiver_cpu', 'packets_per_s', 'bytes_per_s', 'latency_ms',
+               'latency_p95_ms', 'loss']
+    print(' '.join('%18s' % c for c in columns))
+    for r in results:
+        values = []
+        for c in columns:
+            v = r.get(c, '-')
+            values.append('%18.3f' % v if isinstance(v, float) else '%18s' % v)
+        print(' '.join(values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RTP loopback benchmark')
+    parser.add_argument('--subscribers', default='0,1,2,4,8',
+                        help='comma separated subscriber counts to measure')
+    parser.add_argument('--codec', action='append',
+                        help='encoder:decoder pair, may be repeated')
+    parser.add_argument('--payload', choices=sorted(payload.MODES.keys()),
+                        help='payload mode, defaults to ext.conf')
+    parser.add_argument('--fanout', choices=['multiudpsink', 'tee'],
+                        help='fan-out mode, defaults to ext.conf')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to measure each configuration for')
+    parser.add_argument('--warmup', type=float, default=2.0,
+                        help='seconds to run before measuring')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    parser.add_argument('--receive', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--rtcp', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if (args.receive is not None):
+        return receive(args)
+
+    conf = load_config()
+    args.payload = args.payload or conf['payload']
+    codecs = args.codec or ['%s:%s' % (conf['encoder'], conf['decoder'])]
+    results = []
+    for codec in codecs:
+        (encoder, decoder) = codec.split(':')
+        baseline = None
+        for n in [int(n) for n in args.subscribers.split(',')]:
+            r = send(conf, encoder, decoder, n, args)
+            if (n == 0):
+                baseline = r['sender_cpu']
+            elif (baseline is not None):
+                r['cpu_per_subscriber'] = (r['sender_cpu'] - baseline) / n
+            results.append(r)
+    if (args.json):
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,11 +22,36 @@ class Extension(ext.Extension):
         schema['hostname'] = config.String()
         schema['port'] = config.Integer(minimum=1, maximum=65535)
         schema['broadcast_port'] = config.Integer(minimum=1, maximum=65535)
+        schema['station_ttl'] = config.Integer(minimum=1)
         schema['max_subscribers'] = config.Integer(minimum=1)
+        schema['lease_time'] = config.Integer(minimum=2)
+        schema['control_timeout'] = config.Integer(minimum=1)
+        schema['standby_stations'] = config.Integer(minimum=0)
+        schema['control_server'] = config.String(choices=['event', 'actor'])
+        schema['stats_interval'] = config.Integer(minimum=0)
         schema['station_name'] = config.String()
         schema['caps'] = config.String()
         schema['encoder'] = config.String()
         schema['decoder'] = config.String()
+        schema['payload'] = config.String(choices=['gst', 'l16', 'opus'])
+        schema['latency_profile'] = config.String(choices=['lan', 'default', 'wifi'])
+        schema['jitterbuffer_latency'] = config.Integer(minimum=0, optional=True)
+        schema['jitterbuffer_drop'] = config.Boolean(optional=True)
+        schema['receive_buffer_size'] = config.Integer(minimum=0, optional=True)
+        schema['retransmission'] = config.Boolean()
+        schema['retransmission_history'] = config.Integer(minimum=1)
+        schema['fast_join_packets'] = config.Integer(minimum=0)
+        schema['relay'] = config.Boolean()
+        schema['clock_port'] = config.Integer(minimum=1, maximum=65535, optional=True)
+        schema['sync_latency'] = config.Integer(minimum=0)
+        schema['encoder_process'] = config.Boolean()
+        schema['fanout'] = config.String(choices=['multiudpsink', 'tee'])
+        schema['subscriber_queue_size'] = config.Integer(minimum=1)
+        schema['subscriber_drop_policy'] = config.String(choices=['old', 'new'])
+        schema['subscriber_max_drops'] = config.Integer(minimum=0)
+        schema['multicast'] = config.Boolean()
+        schema['multicast_group'] = config.String(optional=True)
+        schema['multicast_port'] = config.Integer(minimum=1, maximum=65535)
         return schema
 
     def validate_environment(self):
@@ -1,15 +1,31 @@
 from __future__ import unicode_literals
 
+import base64
+import collections
+import json
 import logging
+import multiprocessing
+import os
 import pykka
 import gobject
 import socket
+import threading
+import time
+import zlib
 
 from mopidy import backend
 from mopidy import exceptions
 from mopidy import models
 from . import sink
 from session import RtpClientSession
+from .server import RtpControlServer
+from . import beacon
+from . import retransmit
+from .announce import AnnounceScheduler
+from .registry import StationRegistry
+from .stats import Metrics
+from .client import (RtpControlClient, RtpControlError,
+                     RtpCommandError, RtpSubscription, RtpWorker)
 from . import source
 
 from mopidy.utils import encoding, network, process
@@ -37,26 +53,78 @@ def make_uri(addr):
 class RtpLibraryProvider(backend.LibraryProvider):
     """
     Live RTP streams are discovered by the backend and stored
-    under the 'services' dictionary.  RtpLibraryProvider is
-    merely accessing the dictionary of services in order to
+    in its station registry.  RtpLibraryProvider is
+    merely accessing the registry of stations in order to
     provide a list of available live streams.  There are two
     ways of getting hold of a live stream URI.  One is to use
     the :meth:`browse` method which will provide a list of
     :class:`Track` instances for all live streams.
     Alternatively, :meth:`lookup` can be used with a known
-    track URI.  If the services has already been discovered,
+    track URI.  If the station has already been discovered,
     then we return the :class:`Track` to the user.
+    Results are cached until the registry reports that the set
+    of stations has changed.  The registry is changed from the main
+    loop while results are built on the actor thread, so a result
+    built from stations which changed meanwhile is returned but not
+    cached.  Stations are listed least loaded
+    first, and stations which can not take any more subscribers
+    are marked as full.
     """
     root_directory = models.Ref.directory(uri='rtp:', name='RTP')
 
+    def __init__(self, backend):
+        super(RtpLibraryProvider, self).__init__(backend)
+        self.refs = None
+        self.tracks = None
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.backend.stations.add_listener(self._invalidate)
+
+    def _invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.refs = None
+            self.tracks = None
+
+    @staticmethod
+    def _station_name(station):
+        name = station.name
+        if (station.info.relay):
+            name += ' [relay]'
+        if (station.info.full and not station.info.multicast):
+            name += ' [full]'
+        return name
+
+    def _refresh(self):
+        """Returns the refs and tracks of the stations now registered"""
+        generation = self.generation
+        stations = sorted(self.backend.stations.values(),
+                          key=lambda s: (s.info.full and not s.info.multicast,
+                                         s.info.load))
+        refs = [models.Ref.track(uri=make_uri(s.addr),
+                                 name=self._station_name(s))
+                for s in stations]
+        tracks = dict((s.addr, [models.Track(uri=make_uri(s.addr),
+                                             name=self._station_name(s),
+                                             bitrate=s.info.bitrate)])
+                      for s in stations)
+        with self.lock:
+            if (generation == self.generation):
+                self.refs = refs
+                self.tracks = tracks
+        return (refs, tracks)
+
     def browse(self, uri):
-        return [models.Ref.track(uri=make_uri(a), name=self.backend.services[a]) for a in self.backend.services.keys()]
+        refs = self.refs
+        if (refs is None):
+            refs = self._refresh()[0]
+        return refs
 
     def lookup(self, uri):
-        addr = parse_uri(uri)
-        if (addr in self.backend.services.keys()):
-            return [models.Track(uri=uri, name=self.backend.services[addr])]
-        return []
+        tracks = self.tracks
+        if (tracks is None):
+            tracks = self._refresh()[1]
+        return tracks.get(parse_uri(uri), [])
 
 
 class RtpPlaybackProvider(backend.PlaybackProvider):
@@ -68,76 +136,325 @@ class RtpPlaybackProvider(backend.PlaybackProvider):
     Since all streams from this provider are "live" streams,
     it is not possible to seek, pause or resume so these
     operations will all return negatively.
+    The ``standby_stations`` most recently played stations are kept
+    subscribed on standby, so that switching back to one of them
+    needs no subscribe handshake or port allocation.  Leases are
+    renewed and subscriptions given up on a background worker, so that
+    neither Mopidy's main loop nor a station change or stop waits for
+    a station to answer.  The subscriptions are shared with the worker,
+    so they are only changed while holding ``lock``.
     """
+    # Time between asking a station which has only just started
+    # encoding for its caps
+    caps_poll_period = 0.1
+
     def __init__(self, audio, backend):
         super(RtpPlaybackProvider, self).__init__(audio, backend)
         self.uri = None
-        self.host = None
-        self.port = None
+        self.subscription = None
+        self.renew_tag = None
         self.subscribe_port = self.backend.config['port']
+        self.timeout = self.backend.config['control_timeout'] / 1000.0
+        self.clients = {}
+        # Standby subscriptions by host, least recently used first
+        self.standby = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.worker = RtpWorker('RtpControl')
+
+    def _rtp_client(self, host):
+        """Returns the control connection for ``host``, creating it if needed"""
+        with self.lock:
+            client = self.clients.get(host)
+            if (client is None):
+                client = RtpControlClient(host, self.subscribe_port,
+                                          self.timeout)
+                self.clients[host] = client
+        return client
+
+    def _bind_unicast(self):
+        # This allocates a random free client port.  The socket is
+        # kept open and handed to the source element, so nobody else
+        # can take the port and no early packets are lost.
+        u = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._set_receive_buffer(u)
+        u.bind((self.backend.hostname, 0))
+        return u
+
+    @staticmethod
+    def _set_receive_buffer(u):
+        if (source.receive_buffer_size):
+            u.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                         source.receive_buffer_size)
+
+    def _bind_multicast(self, group, port):
+        u = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        u.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._set_receive_buffer(u)
+        # Binding to the group rather than any address keeps out the
+        # traffic of other groups on the same port which this host
+        # has joined, e.g., for a standby station
+        u.bind((group, port))
+        mreq = socket.inet_aton(group) + socket.inet_aton(self.backend.hostname)
+        u.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        return u
+
+    @staticmethod
+    def _rtp_subscribe_command(client, sub):
+        """
+        Sends the command which subscribes ``sub`` and returns the
+        response parameters.  Stations which predate RTCP reports only
+        know "SUBSCRIBE <port>", so that is tried if they do not
+        recognize the command naming our RTCP port.
+        """
+        if (sub.group):
+            return client.command('JOIN')
+        try:
+            return client.command('SUBSCRIBE %d %d' %
+                                  (sub.port, sub.rtcp_sock.getsockname()[1]))
+        except RtpCommandError as e:
+            if (e.code != 'ERROR_UNRECOGNIZED_COMMAND'):
+                raise
+        return client.command('SUBSCRIBE %d' % sub.port)
 
     def _rtp_subscribe(self, host):
+        """
+        Subscribes to the station on ``host`` and returns the
+        :class:`RtpSubscription`.  Multicast is always tried first
+        since it costs the station nothing per listener, falling back
+        to unicast.
+        """
+        client = self._rtp_client(host)
+        sub = None
         try:
-            # This should allocate a random free client port
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.bind((self.backend.hostname, 0))
-            port = s.getsockname()[1]
-            s.close()
-            # Connect to server to subscribe to stream on our alloc'd port
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((host, self.subscribe_port))
-            resp = s.recv(1024)
-            logger.debug('Connection Reply: %s', resp)
-            msg = 'SUBSCRIBE %d\n' % port
-            s.send(msg)
-            resp = s.recv(1024)
-            logger.debug('Subscribe Reply: %s', resp)
-            s.close()
-            if (resp.rstrip() == 'ERROR_OK'):
-                return port
-        except:
+            params = client.command('JOIN')
+            (group, port) = (params['group'], int(params['port']))
+            try:
+                # Sender reports are sent to the group on port + 1
+                u = self._bind_multicast(group, port)
+                r = self._bind_multicast(group, port + 1)
+            except socket.error:
+                client.command('LEAVE')
+                raise
+            sub = RtpSubscription(host, group, port, u, r, params)
+        except RtpCommandError:
             pass
+        if (sub is None):
+            u = self._bind_unicast()
+            r = self._bind_unicast()
+            sub = RtpSubscription(host, None, u.getsockname()[1], u, r,
+                                  {'lease': 0})
+            # Subscribe to unicast stream on our alloc'd ports
+            try:
+                sub.update(self._rtp_subscribe_command(client, sub))
+            except RtpControlError:
+                sub.close()
+                raise
+        self._rtp_await_caps(client, sub)
+        return sub
+
+    def _rtp_await_caps(self, client, sub):
+        """
+        Asks the station for its caps until it has negotiated them, for
+        at most the control timeout.  A station only starts encoding
+        for its first subscriber, so it can not have told them yet.
+        """
+        deadline = time.time() + self.timeout
+        while (not sub.caps and time.time() < deadline):
+            time.sleep(self.caps_poll_period)
+            try:
+                sub.update(client.command('CAPS'))
+            except RtpControlError as e:
+                # Stations which predate the CAPS command never send
+                # caps, so their subscribers use the configured ones
+                logger.debug('No caps from RTP station %s: %s', sub.host, e)
+                return
 
-    def _rtp_unsubscribe(self, host, port):
+    def _rtp_renew(self, sub):
+        client = self._rtp_client(sub.host)
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((host, self.subscribe_port))
-            resp = s.recv(1024)
-            logger.debug('Connection Reply: %s', resp)
-            msg = 'UNSUBSCRIBE %d\n' % port
-            s.send(msg)
-            resp = s.recv(1024)
-            logger.debug('Unsubscribe Reply: %s', resp)
-            s.close()
-            if (resp.rstrip() == 'ERROR_OK'):
-                return True
-        except:
-            pass
+            if (sub.group):
+                params = client.command('RENEW')
+            else:
+                params = client.command('RENEW %d' % sub.port)
+        except RtpCommandError as e:
+            if (e.code != 'ERROR_NOT_SUBSCRIBED'):
+                raise
+            # Our lease was reclaimed, so subscribe again
+            params = self._rtp_subscribe_command(client, sub)
+        sub.update(params)
+
+    def _rtp_unsubscribe(self, sub):
+        client = self._rtp_client(sub.host)
+        if (sub.group):
+            client.command('LEAVE')
+        else:
+            client.command('UNSUBSCRIBE %d' % sub.port)
+
+    def _rtp_resume(self, sub):
+        """
+        Makes the standby subscription ``sub`` current again, fetching
+        the stream parameters in case the station's stream changed
+        """
+        sub.update(self._rtp_client(sub.host).command('CAPS'))
+        # Packets received on standby are long out of date
+        for sock in (sub.sock, sub.rtcp_sock):
+            sock.setblocking(False)
+            try:
+                while (True):
+                    sock.recv(65536)
+            except socket.error:
+                pass
+            finally:
+                sock.setblocking(True)
+
+    def _unsubscribe(self, sub):
+        # Runs on the worker
+        try:
+            self._rtp_unsubscribe(sub)
+        except RtpControlError as e:
+            # The lease will expire on the station anyway
+            logger.warn('Failed to unsubscribe from RTP station %s: %s',
+                        sub.host, e)
+        sub.close()
+
+    def _release(self, sub):
+        """Puts ``sub`` on standby, unsubscribing from the oldest one"""
+        with self.lock:
+            self.standby[sub.host] = sub
+            while (len(self.standby) > self.backend.config['standby_stations']):
+                self.worker.submit(self._unsubscribe,
+                                   self.standby.popitem(last=False)[1])
 
+    def _subscriptions(self):
+        with self.lock:
+            subs = list(self.standby.values())
+            if (self.subscription):
+                subs.append(self.subscription)
+        return subs
+
+    def _schedule_renew(self, lease=None):
+        # Renew at half the shortest lease time so that a single lost
+        # renewal does not cost us the subscription
+        with self.lock:
+            self._cancel_renew()
+            if (lease is None):
+                # Stations which predate leases never expire us
+                leases = [sub.lease for sub in self._subscriptions()
+                          if sub.lease]
+                if (not leases):
+                    return
+                lease = min(leases)
+            self.renew_tag = gobject.timeout_add(lease * 500,
+                                                 self._on_renew_due)
+
+    def _cancel_renew(self):
+        with self.lock:
+            if (self.renew_tag is not None):
+                gobject.source_remove(self.renew_tag)
+                self.renew_tag = None
+
+    def _on_renew_due(self):
+        # Runs on the main loop, which must not wait for stations
+        with self.lock:
+            self.renew_tag = None
+        self.worker.submit(self._renew_lease)
         return False
 
+    def _renew_lease(self):
+        # Runs on the worker
+        with self.lock:
+            standby = list(self.standby.items())
+        for (host, sub) in standby:
+            try:
+                self._rtp_renew(sub)
+            except RtpControlError as e:
+                with self.lock:
+                    # Unless it has been played again meanwhile
+                    dropped = self.standby.get(host) is sub
+                    if (dropped):
+                        del self.standby[host]
+                if (dropped):
+                    logger.info('Dropping RTP standby station %s: %s', host, e)
+                    sub.close()
+        sub = self.subscription
+        if (sub):
+            try:
+                self._rtp_renew(sub)
+            except RtpControlError as e:
+                logger.warn('Failed to renew RTP lease from %s: %s',
+                            sub.host, e)
+                # Keep trying since the station may come back
+                self._schedule_renew(1)
+                return
+        self._schedule_renew()
+
     def change_track(self, track):
         if (track.uri != self.uri):
             host = parse_uri(track.uri)
-            port = self._rtp_subscribe(host)
-            if (port):
-                self.uri = track.uri
-                self.host = host
-                self.port = port
-                self.audio.set_uri('rtp://' + str(port)).get()
-                return True
-            else:
+            station = self.backend.stations.get(host)
+            if (station and station.info.origin == self.backend.config['hostname']):
+                # Our own stream would be relayed straight back to us
+                logger.warn('RTP station %s is relaying this station', host)
                 return False
+            with self.lock:
+                sub = self.standby.pop(host, None)
+            if (sub):
+                try:
+                    self._rtp_resume(sub)
+                except RtpControlError as e:
+                    logger.info('RTP standby station %s lost: %s', host, e)
+                    self.worker.submit(sub.close)
+                    sub = None
+            if (sub is None):
+                # A standby subscription may hold the station's last
+                # slot, so fullness only matters when subscribing afresh
+                if (station and station.info.full and
+                        not station.info.multicast):
+                    logger.warn('RTP station %s is full', host)
+                    return False
+                try:
+                    sub = self._rtp_subscribe(host)
+                except (RtpControlError, socket.error) as e:
+                    logger.warn('Failed to subscribe to RTP station %s: %s',
+                                host, e)
+                    return False
+            with self.lock:
+                if (self.subscription):
+                    self._release(self.subscription)
+                self.uri = track.uri
+                self.subscription = sub
+            self._schedule_renew()
+            self.audio.set_uri(sub.source_uri()).get()
+            if (self.backend.config['relay']):
+                self.backend._announce_change()
         return True
 
     def stop(self):
-        if (self.host and self.port):
-            if (self.audio.stop_playback().get() and
-                self._rtp_unsubscribe(self.host, self.port)):
-                self.uri = self.host = self.port = None
-                return True
+        sub = self.subscription
+        if (sub):
+            self._cancel_renew()
+            if (not self.audio.stop_playback().get()):
+                return False
+            with self.lock:
+                self.uri = self.subscription = None
+                self._release(sub)
+            self._schedule_renew()
+            if (self.backend.config['relay']):
+                self.backend._announce_change()
+            return True
         return False
 
+    def shutdown(self):
+        """Unsubscribes from every station, waiting a bounded time"""
+        self._cancel_renew()
+        with self.lock:
+            subs = self._subscriptions()
+            self.standby.clear()
+            self.uri = self.subscription = None
+        for sub in subs:
+            self.worker.submit(self._unsubscribe, sub)
+        self.worker.stop(self.timeout * (len(subs) + 1))
+
     def seek(self, time_position):
         return False
 
@@ -158,92 +475,488 @@ class RtpBackend(pykka.ThreadingActor, backend.Backend):
     * The currently playing stream is advertised as a live stream for an RTP
       client whom may choose to listen to it.  This information is
       broadcast over a selected network to any clients whom wish to
-      discover new RTP services.
+      discover new RTP services.  Announcements are sent in a short
+      burst on startup and whenever the station changes, and then
+      back off exponentially.  Peers may broadcast a discovery query
+      to have every station announce itself immediately.
     * A client may subscribe to the currently playing live stream by
       contacting the backend and requesting which UDP port they wish
       the RTP stream to be sent on.
-    :note: Each stream is setup as a unicast UDP session, even when
-        multiple clients are subscribing.  This uses more bandwidth
-        over the network but is more reliable than trying to
+    * Each subscription is a lease of ``lease_time`` seconds which the
+      client must renew.  Subscriptions which are not renewed in time
+      are reclaimed, so a client which disappears without unsubscribing
+      stops costing bandwidth and does not hold a subscriber slot.
+    :note: By default each stream is setup as a unicast UDP session,
+        even when multiple clients are subscribing.  This uses more
+        bandwidth over the network but is more reliable than trying to
         multicast which is notoriously problematic on WiFi networks.
+        Stations on networks which handle multicast well may enable
+        it, in which case a single stream is sent to the multicast
+        group however many clients join it.  Clients fall back to
+        unicast whenever a station does not offer multicast.
     """
-    broadcast_period = 1.0
+    announce_min_period = 1.0
+    announce_max_period = 30.0
+    announce_burst = 3
+    announce_jitter = 0.2
+    query_holdoff = 0.5
     max_broadcast_packet = 1470
+    lease_check_period = 1.0
+    station_check_period = 1.0
+    quality_check_period = 5.0
+    quality_loss_warning = 0.05
+    eviction_check_period = 5.0
+    eviction_strikes = 2
+    eviction_holdoff = 60.0
+    max_control_connections = 64
+    control_connection_timeout = 30
+    max_nack_packet = 1500
 
     def __init__(self, config, audio):
         super(RtpBackend, self).__init__()
         self.name = RTP_SERVICE_NAME
         self.public = True
         self.config = config['rtp']
+        if (self.config['encoder_process'] and
+                (self.config['relay'] or self.config['retransmission'])):
+            # Both need the sent packets, which stay in the worker
+            logger.warn('RTP relay and retransmission are not supported '
+                        'with encoder_process and have been disabled')
+            self.config = dict(self.config, relay=False, retransmission=False)
         self.audio = audio
+        self.stations = StationRegistry(self.config['station_ttl'])
         self.library = RtpLibraryProvider(backend=self)
         self.playback = RtpPlaybackProvider(audio=audio, backend=self)
         self.uri_schemes = ['rtp']
         self.hostname = network.format_hostname(self.config['hostname'])
+        self.multicast_group = self._multicast_group(self.config)
         self.port = self.config['port']
         self.sock = None
-        self.services = {}
+        self.nack_sock = None
+        self.control_server = None
+        self.broadcast_addr = None
+        self.last_broadcast = 0
+        self.bitrate_sample = (time.time(), 0)
+        self.bitrate = 0
+        self.announcer = AnnounceScheduler(self.announce_min_period,
+                                           self.announce_max_period,
+                                           self.announce_burst,
+                                           self.announce_jitter)
         self.event_sources = {}
-        self.subscribers = []
+        # Subscribers and multicast listeners map to lease expiry times
+        self.subscribers = {}
+        self.multicast_listeners = {}
+        self.subscriber_stats = {}
+        # Subscribers map to (packets dropped, consecutive periods
+        # behind) and evicted subscribers to when they may return
+        self.drop_samples = {}
+        self.evicted = {}
+        self.metrics = Metrics()
         source.decoder = self.config['decoder']
         source.caps_string = self.config['caps']
+        (source.latency, source.drop_on_latency,
+         source.receive_buffer_size) = self._latency_profile(self.config)
         sink.encoder = self.config['encoder']
+        sink.payload_mode = self.config['payload']
+        sink.fanout = self.config['fanout']
+        sink.rtcp_port = self.config['port']
+        sink.queue_size = self.config['subscriber_queue_size']
+        sink.drop_policy = self.config['subscriber_drop_policy']
+        sink.fast_join_packets = self.config['fast_join_packets']
+        sink.clock_port = self.config['clock_port'] or 0
+        sink.retransmission_history = 0
+        if (self.config['retransmission']):
+            sink.retransmission_history = self.config['retransmission_history']
+
+    @staticmethod
+    def _latency_profile(config):
+        """
+        Returns the receive settings of the configured latency profile,
+        with any settings which are explicitly configured overriding it
+        """
+        (latency, drop, size) = source.PROFILES[config['latency_profile']]
+        if (config['jitterbuffer_latency'] is not None):
+            latency = config['jitterbuffer_latency']
+        if (config['jitterbuffer_drop'] is not None):
+            drop = config['jitterbuffer_drop']
+        if (config['receive_buffer_size'] is not None):
+            size = config['receive_buffer_size']
+        return (latency, drop, size)
+
+    @staticmethod
+    def _multicast_group(config):
+        """
+        Returns the station's multicast group which, unless configured,
+        is derived from the last two octets of the station's address so
+        that stations on the same network never share a group
+        """
+        if (config['multicast_group']):
+            return config['multicast_group']
+        octets = config['hostname'].split('.')
+        return '239.255.%s.%s' % (octets[2], octets[3])
 
     @staticmethod
     def _audio_sink_name(host, port):
         return RTP_SERVICE_NAME + ':audio:' + str(port) + '@' + host
 
-    def _start_rtp_session(self, host, port):
+    def _relayed(self):
+        """Returns the subscription being relayed, if any"""
+        if (self.sink.relaying):
+            return self.playback.subscription
+        return None
+
+    def _stream_params(self, multicast=False):
+        """
+        Returns the stream parameters sent to subscribers, including
+        the caps negotiated by the sink once they are known.  Only the
+        gst payload mode needs a decoder to be named, since the other
+        modes' decoders follow from their caps.  A relay passes on the
+        parameters of the station it relays.  ``multicast`` listeners
+        are not offered retransmission, since their sockets only
+        receive the group's traffic.
+        """
+        relayed = self._relayed()
+        if (relayed):
+            params = 'rtcp=%d' % self.port
+            for name in ('payload', 'caps', 'decoder', 'clock', 'latency'):
+                if (getattr(relayed, name)):
+                    params += ' %s=%s' % (name, getattr(relayed, name))
+        else:
+            params = 'rtcp=%d payload=%s' % (self.port, self.config['payload'])
+        if (not relayed and self.sink.caps):
+            params += ' caps=%s' % base64.urlsafe_b64encode(
+                self.sink.caps.encode('utf-8'))
+        if (not relayed and self.config['payload'] == 'gst'):
+            params += ' decoder=%s' % self.config['decoder']
+        if (self.nack_sock and not multicast):
+            params += ' nack=%d' % self.nack_sock.getsockname()[1]
+        if (not relayed and self.config['clock_port']):
+            params += ' clock=%s:%d latency=%d' % (
+                self.config['hostname'], self.config['clock_port'],
+                self.config['sync_latency'])
+        return params
+
+    def _lease_expiry(self):
+        return time.time() + self.config['lease_time']
+
+    def _start_rtp_session(self, host, port, rtcp=None):
+        if ((host, port) in self.subscribers):
+            self.subscribers[(host, port)] = self._lease_expiry()
+            return True
+        if (self.evicted.get((host, port), 0) > time.time()):
+            return False
         if (len(self.subscribers) < self.config['max_subscribers']):
-            self.subscribers.append((host, port))
-            self.sink.add(host, port)
+            self.subscribers[(host, port)] = self._lease_expiry()
+            self.sink.fast_join(host, port)
+            self.sink.add(host, port, rtcp)
+            self._announce_change()
             return True
         else:
             return False
 
+    def _renew_rtp_session(self, host, port):
+        if ((host, port) in self.subscribers):
+            self.subscribers[(host, port)] = self._lease_expiry()
+            return True
+        return False
+
     def _stop_rtp_session(self, host, port):
         host = host.split(':')[-1]
         if ((host, port) in self.subscribers):
-            self.subscribers.remove((host, port))
+            del self.subscribers[(host, port)]
             self.sink.remove(host, port)
+            self._announce_change()
         else:
             logger.warn('Subscriber %s:%s can not be removed - not in subscriber list', host, port)
 
-    def _broadcast_service_info(self):
+    def _join_multicast(self, host):
+        if (not self.config['multicast']):
+            return None
+        group = (self.multicast_group, self.config['multicast_port'])
+        # No fast join burst is sent, since the listener only binds its
+        # group socket once it has our reply, and a socket bound to the
+        # group does not receive unicast anyway
+        if (not self.multicast_listeners):
+            self.sink.add(group[0], group[1])
+        self.multicast_listeners[host] = self._lease_expiry()
+        return group
+
+    def _renew_multicast(self, host):
+        if (host in self.multicast_listeners):
+            self.multicast_listeners[host] = self._lease_expiry()
+            return True
+        return False
+
+    def _leave_multicast(self, host):
+        host = host.split(':')[-1]
+        if (host in self.multicast_listeners):
+            del self.multicast_listeners[host]
+            if (not self.multicast_listeners):
+                self.sink.remove(self.multicast_group,
+                                 self.config['multicast_port'])
+        else:
+            logger.warn('Listener %s can not leave - not in multicast group', host)
+
+    def _expire_leases(self):
+        now = time.time()
+        for ((host, port), expiry) in self.subscribers.items():
+            if (expiry < now):
+                logger.info('Lease expired for subscriber %s:%s', host, port)
+                self._stop_rtp_session(host, port)
+        for (host, expiry) in self.multicast_listeners.items():
+            if (expiry < now):
+                logger.info('Lease expired for multicast listener %s', host)
+                self._leave_multicast(host)
+        return True
+
+    def _start_broadcast(self):
         broadcast_addr = self.config['hostname'].split('.')
         broadcast_addr[3] = '255'
-        broadcast_addr = '.'.join(broadcast_addr)
-        if (not self.sock):
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            self.sock.bind((broadcast_addr, self.config['broadcast_port']))
-            tag = gobject.io_add_watch(self.sock.fileno(), gobject.IO_IN,
-                                       self._receive_service_info,
-                                       None)
-            self.event_sources['service'] = tag
-            logger.info('RTP broadcast running on [%s]:%s', broadcast_addr,
-                        self.config['broadcast_port'])
-        msg = self.config['station_name'].replace('%hostname', self.config['hostname'])
-        msg = msg.replace('%port', str(self.config['port']))
-        self.sock.sendto(msg, (broadcast_addr, self.config['broadcast_port']))
-        tag = gobject.timeout_add(int(self.broadcast_period * 1000),
+        self.broadcast_addr = '.'.join(broadcast_addr)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.bind((self.broadcast_addr, self.config['broadcast_port']))
+        tag = gobject.io_add_watch(self.sock.fileno(), gobject.IO_IN,
+                                   self._receive_service_info,
+                                   None)
+        self.event_sources['service'] = tag
+        logger.info('RTP broadcast running on [%s]:%s', self.broadcast_addr,
+                    self.config['broadcast_port'])
+        # Ask peers to announce themselves, so that we learn about
+        # them straight away rather than waiting for their next period
+        self._send_broadcast(beacon.encode_query())
+        self._broadcast_service_info()
+
+    def _send_broadcast(self, msg):
+        self.sock.sendto(msg, (self.broadcast_addr, self.config['broadcast_port']))
+
+    def _start_retransmission(self):
+        # Subscribers send NACKs for the packets they have lost to the
+        # socket the stream is sent from, which sends the packets back
+        # to them from history.  Packets from any other address would
+        # be dropped by the subscriber as a colliding sender.
+        self.nack_sock = self.sink.sock
+        tag = gobject.io_add_watch(self.nack_sock.fileno(), gobject.IO_IN,
+                                   self._receive_nack)
+        self.event_sources['nack'] = tag
+        logger.info('RTP retransmission running at [%s]:%s', self.hostname,
+                    self.nack_sock.getsockname()[1])
+
+    def _receive_nack(self, source=None, cb_condition=None):
+        try:
+            (data, addr) = self.nack_sock.recvfrom(self.max_nack_packet)
+            seqs = retransmit.decode_nack(data)
+        except socket.error as e:
+            logger.debug('Failed to receive NACK: %s', e)
+            return True
+        except ValueError as e:
+            logger.debug('Ignoring malformed NACK from %s: %s', addr, e)
+            return True
+        # The NACK comes from the socket the subscriber receives on,
+        # which is also where the packets must be sent again.  That
+        # excludes multicast listeners, whose sockets are bound to the
+        # group and can not receive unicast.
+        if ((addr[0], addr[1]) not in self.subscribers):
+            logger.debug('Ignoring NACK from non-subscriber %s:%s', *addr)
+            return True
+        self.metrics.incr('retransmission.nacks')
+        for packet in self.sink.retransmit(seqs):
+            try:
+                self.nack_sock.sendto(packet, addr)
+            except socket.error as e:
+                logger.debug('Failed to retransmit to %s:%s: %s',
+                             addr[0], addr[1], e)
+                break
+        return True
+
+    def _measure_bitrate(self):
+        """Returns the sink's output bitrate in kbit/s since last called"""
+        now = time.time()
+        (then, sent) = self.bitrate_sample
+        self.bitrate_sample = (now, self.sink.bytes_sent)
+        if (now > then and self.sink.bytes_sent > sent):
+            # Keep the last measurement while the encoder is idle
+            self.bitrate = int((self.sink.bytes_sent - sent) * 8 / (now - then) / 1000)
+        return self.bitrate
+
+    @staticmethod
+    def _cpu_load():
+        try:
+            return int(100 * os.getloadavg()[0] / multiprocessing.cpu_count())
+        except (OSError, NotImplementedError):
+            return 0
+
+    def _beacon(self):
+        name = self.config['station_name'].replace('%hostname', self.config['hostname'])
+        name = name.replace('%port', str(self.config['port']))
+        caps = self.sink.caps or self.config['caps']
+        flags = 0
+        if (self.config['multicast']):
+            flags |= beacon.FLAG_MULTICAST
+        codec = self.config['encoder']
+        if (self.config['payload'] != 'gst'):
+            codec = self.config['payload']
+        origin = None
+        relayed = self._relayed()
+        if (relayed):
+            flags |= beacon.FLAG_RELAY
+            # Relays of relays give the station the stream comes from
+            station = self.stations.get(relayed.host)
+            origin = relayed.host
+            if (station and station.info.origin):
+                origin = station.info.origin
+            if (relayed.caps):
+                caps = base64.urlsafe_b64decode(str(relayed.caps)).decode('utf-8')
+            codec = relayed.decoder or relayed.payload or codec
+        caps_id = zlib.crc32(caps.encode('utf-8')) & 0xffffffff
+        return beacon.Beacon(name, self.config['port'],
+                             len(self.subscribers),
+                             self.config['max_subscribers'],
+                             codec,
+                             caps_id,
+                             self._measure_bitrate(), self._cpu_load(), flags,
+                             origin)
+
+    def _broadcast_service_info(self):
+        self._send_broadcast(beacon.encode_announce(self._beacon()))
+        self.last_broadcast = time.time()
+        tag = gobject.timeout_add(int(self.announcer.next_interval() * 1000),
                                   self._broadcast_service_info)
         self.event_sources['broadcast'] = tag
         return False
 
+    def _announce_now(self):
+        """Restarts the announcement schedule with an immediate burst"""
+        self.event_sources.pop('announce', None)
+        if (self.sock is not None):
+            self._deregister_event_source('broadcast')
+            self.announcer.reset()
+            self._broadcast_service_info()
+        return False
+
+    def _announce_change(self):
+        """
+        Announces a change in the station's state to peers.  May be
+        called from any thread, and changes in quick succession only
+        result in a single burst.
+        """
+        if ('announce' not in self.event_sources):
+            self.event_sources['announce'] = gobject.idle_add(self._announce_now)
+
     def _receive_service_info(self, source=None, cb_condition=None, cb_arg=None):
         try:
             (data, addr) = self.sock.recvfrom(self.max_broadcast_packet)
             if (data):
-                logger.debug('Received broadcast packet %s from %s', data, addr)
-                if (addr[0] != self.config['hostname']):
-                    self.services[addr[0]] = data
-        except:
-            logger.error('No broadcast packet found')
+                logger.debug('Received broadcast packet %r from %s', data, addr)
+                if (addr[0] == self.config['hostname']):
+                    return True
+                (msg_type, info) = beacon.decode(data)
+                if (msg_type == beacon.TYPE_QUERY):
+                    # Answer with a single announcement unless we only
+                    # just announced, e.g., for someone else's query
+                    if (time.time() - self.last_broadcast > self.query_holdoff):
+                        self._deregister_event_source('broadcast')
+                        self._broadcast_service_info()
+                elif (msg_type == beacon.TYPE_BYE):
+                    self.stations.remove(addr[0])
+                elif (msg_type == beacon.TYPE_ANNOUNCE):
+                    self.stations.update(addr[0], info)
+        except ValueError as e:
+            logger.debug('Ignoring malformed broadcast packet: %s', e)
+        except socket.error as e:
+            logger.error('Failed to receive broadcast packet: %s', e)
+        return True
+
+    def _update_quality_stats(self):
+        stats = self.sink.get_stats()
+        for (host, s) in stats.items():
+            if (s['fraction_lost'] > self.quality_loss_warning):
+                logger.warn('RTP subscriber %s is losing %d%% of packets',
+                            host, int(s['fraction_lost'] * 100))
+        self.subscriber_stats = stats
+        return True
+
+    def _evict_slow_subscribers(self):
+        """
+        Evicts any subscriber whose queue has dropped more than
+        ``subscriber_max_drops`` packets in each of ``eviction_strikes``
+        periods in a row, i.e., which is persistently falling behind.
+        An evicted subscriber may not subscribe again for
+        ``eviction_holdoff`` seconds.
+        """
+        now = time.time()
+        samples = {}
+        for (dest, drops) in self.sink.get_drops().items():
+            if (dest not in self.subscribers):
+                continue
+            (last, strikes) = self.drop_samples.get(dest, (0, 0))
+            if (drops - last > self.config['subscriber_max_drops']):
+                strikes += 1
+            else:
+                strikes = 0
+            if (strikes >= self.eviction_strikes):
+                logger.warn('Evicting RTP subscriber %s:%s which is falling behind',
+                            dest[0], dest[1])
+                self.metrics.incr('subscribers.evicted')
+                self.evicted[dest] = now + self.eviction_holdoff
+                self._stop_rtp_session(dest[0], dest[1])
+                continue
+            samples[dest] = (drops, strikes)
+        self.drop_samples = samples
+        for (dest, until) in self.evicted.items():
+            if (until < now):
+                del self.evicted[dest]
+        return True
+
+    def get_subscriber_stats(self):
+        """
+        Returns a dictionary keyed by subscriber host of the latest
+        quality statistics reported by that subscriber over RTCP, see
+        :meth:`sink.RtpSink.get_stats`
+        """
+        return dict(self.subscriber_stats)
+
+    def get_stats(self):
+        """
+        Returns a dictionary of every counter and gauge for the control
+        server, the sink and any RTP sources, keyed by dotted name
+        """
+        stats = self.metrics.snapshot()
+        stats['subscribers'] = len(self.subscribers)
+        stats['multicast_listeners'] = len(self.multicast_listeners)
+        stats['stations'] = len(self.stations)
+        for (name, value) in self.sink.get_counters().items():
+            stats['sink.' + name] = value
+        for (host, quality) in self.subscriber_stats.items():
+            for (name, value) in quality.items():
+                stats['sink.quality.%s.%s' % (host, name)] = value
+        for (i, s) in enumerate(list(source.instances)):
+            for (name, value) in s.get_stats().items():
+                stats['source.%d.%s' % (i, name)] = value
+        return stats
+
+    def _log_stats(self):
+        logger.info('RTP stats: %s', json.dumps(self.get_stats(), sort_keys=True))
+        return True
+
+    def _expire_stations(self):
+        self.stations.expire()
         return True
 
     def _start_rtp_client_server(self):
+        if (self.config['control_server'] == 'event'):
+            try:
+                self.control_server = RtpControlServer(
+                    self, self.hostname, self.port,
+                    self.max_control_connections,
+                    self.control_connection_timeout)
+            except (IOError, socket.error) as error:
+                raise exceptions.BackendError(
+                    'RTP server startup failed: %s' %
+                    encoding.locale_decode(error))
+            logger.info('RTP server running at [%s]:%s', self.hostname, self.port)
+            return
         try:
             network.Server(
                 self.hostname,
@@ -252,7 +965,8 @@ class RtpBackend(pykka.ThreadingActor, backend.Backend):
                 protocol_kwargs={
                     'backend': self,
                 },
-                max_connections=self.config['max_subscribers'])
+                max_connections=self.max_control_connections,
+                timeout=self.control_connection_timeout)
         except IOError as error:
             raise exceptions.BackendError(
                 'RTP server startup failed: %s' %
@@ -260,7 +974,11 @@ class RtpBackend(pykka.ThreadingActor, backend.Backend):
         logger.info('RTP server running at [%s]:%s', self.hostname, self.port)
 
     def _stop_rtp_client_server(self):
-        process.stop_actors_by_class(RtpClientSession)
+        if (self.control_server is not None):
+            self.control_server.stop()
+            self.control_server = None
+        else:
+            process.stop_actors_by_class(RtpClientSession)
 
     def _deregister_event_source(self, source):
         tag = self.event_sources.pop(source, None)
@@ -273,18 +991,52 @@ class RtpBackend(pykka.ThreadingActor, backend.Backend):
 
     def on_start(self):
         if (self.sock is None):
-            self.sink = sink.RtpSink()
+            if (self.config['encoder_process']):
+                self.sink = sink.RtpWorkerSink()
+            else:
+                self.sink = sink.RtpSink()
             self.audio.add_sink('rtp:sink', self.sink)
+            if (self.config['relay']):
+                source.relay = self.sink.relay
             self._start_rtp_client_server()
-            self._broadcast_service_info()
+            self._start_broadcast()
+            if (self.config['retransmission']):
+                self._start_retransmission()
+            tag = gobject.timeout_add(int(self.lease_check_period * 1000),
+                                      self._expire_leases)
+            self.event_sources['lease'] = tag
+            tag = gobject.timeout_add(int(self.station_check_period * 1000),
+                                      self._expire_stations)
+            self.event_sources['expiry'] = tag
+            tag = gobject.timeout_add(int(self.quality_check_period * 1000),
+                                      self._update_quality_stats)
+            self.event_sources['quality'] = tag
+            if (self.config['subscriber_max_drops']):
+                tag = gobject.timeout_add(int(self.eviction_check_period * 1000),
+                                          self._evict_slow_subscribers)
+                self.event_sources['eviction'] = tag
+            if (self.config['stats_interval']):
+                tag = gobject.timeout_add(self.config['stats_interval'] * 1000,
+                                          self._log_stats)
+                self.event_sources['stats'] = tag
 
     def on_stop(self):
         if (self.sock is not None):
             self._deregister_event_sources()
+            source.relay = None
+            self._send_broadcast(beacon.encode_bye())
             self._stop_rtp_client_server()
-            for s in self.subscribers:
+            for s in self.subscribers.keys():
                 self._stop_rtp_session(s[0], s[1])
+            for h in self.multicast_listeners.keys():
+                self._leave_multicast(h)
             self.audio.remove_sink('rtp:sink')
+            self.sink.close()
+            self.playback.shutdown()
+            for c in self.playback.clients.values():
+                c.close()
+            # The NACK socket belongs to the sink
+            self.nack_sock = None
             self.sock = None
-            self.services = {}
+            self.stations.clear()
             self.sink = None
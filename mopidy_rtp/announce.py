@@ -0,0 +1,34 @@
+from __future__ import unicode_literals
+
+import random
+
+
+class AnnounceScheduler(object):
+    """
+    Decides when a station should next announce itself.  After a
+    :meth:`reset`, i.e., on startup or whenever the station's state
+    changes, a burst of ``burst`` announcements is sent every
+    ``min_period`` seconds.  Thereafter the period doubles with each
+    announcement up to ``max_period`` seconds.  Every period is
+    randomly spread by +/- ``jitter`` (a fraction of the period) so
+    that peers which started together do not stay in lock-step.
+    """
+    def __init__(self, min_period, max_period, burst, jitter):
+        self.min_period = min_period
+        self.max_period = max_period
+        self.burst = burst
+        self.jitter = jitter
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def next_interval(self):
+        """Returns the number of seconds until the next announcement"""
+        if (self.count < self.burst):
+            period = self.min_period
+        else:
+            backoff = min(self.count - self.burst + 1, 16)
+            period = min(self.min_period * (2 ** backoff), self.max_period)
+        self.count += 1
+        return period * random.uniform(1 - self.jitter, 1 + self.jitter)
@@ -0,0 +1,137 @@
+from __future__ import unicode_literals
+
+import struct
+
+# Every beacon starts with a fixed header of magic, version and type
+MAGIC = b'MRTP'
+VERSION = 1
+HEADER = struct.Struct(b'!4sBB')
+
+TYPE_ANNOUNCE = 1
+TYPE_QUERY = 2
+TYPE_BYE = 3
+
+FLAG_MULTICAST = 0x01
+FLAG_RELAY = 0x02
+
+# Announcement body: flags, control port, subscribers, max subscribers,
+# caps id, bitrate (kbit/s) and load (percent of all CPUs), followed
+# by the station name and codec as length prefixed UTF-8 strings.
+# Relays append the address of the station they relay.
+ANNOUNCE = struct.Struct(b'!BHHHIIB')
+NAME_LENGTH = struct.Struct(b'!H')
+CODEC_LENGTH = struct.Struct(b'!B')
+ORIGIN_LENGTH = struct.Struct(b'!B')
+
+
+class Beacon(object):
+    """
+    The information a station announces about itself.  Beacons from
+    peers running an older version of this extension only carry the
+    station name, in which case every other field is None.  A station
+    relaying another station's stream gives its address as ``origin``.
+    """
+    fields = ('name', 'port', 'subscribers', 'max_subscribers', 'codec',
+              'caps_id', 'bitrate', 'load', 'flags', 'origin')
+
+    def __init__(self, name, port=None, subscribers=None,
+                 max_subscribers=None, codec=None, caps_id=None,
+                 bitrate=None, load=None, flags=0, origin=None):
+        self.name = name
+        self.port = port
+        self.subscribers = subscribers
+        self.max_subscribers = max_subscribers
+        self.codec = codec
+        self.caps_id = caps_id
+        self.bitrate = bitrate
+        self.load = load
+        self.flags = flags
+        self.origin = origin
+
+    def _values(self):
+        return tuple(getattr(self, f) for f in self.fields)
+
+    def __eq__(self, other):
+        return isinstance(other, Beacon) and self._values() == other._values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def multicast(self):
+        return bool(self.flags & FLAG_MULTICAST)
+
+    @property
+    def relay(self):
+        return bool(self.flags & FLAG_RELAY)
+
+    @property
+    def full(self):
+        """True if the station is known to accept no more unicast subscribers"""
+        if (self.subscribers is None or self.max_subscribers is None):
+            return False
+        return self.subscribers >= self.max_subscribers
+
+
+def _header(msg_type):
+    return HEADER.pack(MAGIC, VERSION, msg_type)
+
+
+def encode_announce(beacon):
+    name = beacon.name.encode('utf-8')[:1024]
+    codec = beacon.codec.encode('utf-8')[:255]
+    data = (_header(TYPE_ANNOUNCE) +
+            ANNOUNCE.pack(beacon.flags, beacon.port, beacon.subscribers,
+                          beacon.max_subscribers, beacon.caps_id,
+                          beacon.bitrate, min(beacon.load, 255)) +
+            NAME_LENGTH.pack(len(name)) + name +
+            CODEC_LENGTH.pack(len(codec)) + codec)
+    if (beacon.relay):
+        origin = beacon.origin.encode('utf-8')[:255]
+        data += ORIGIN_LENGTH.pack(len(origin)) + origin
+    return data
+
+
+def encode_query():
+    return _header(TYPE_QUERY)
+
+
+def encode_bye():
+    return _header(TYPE_BYE)
+
+
+def _string(data, offset, length_struct):
+    end = offset + length_struct.size
+    (length,) = length_struct.unpack(data[offset:end])
+    if (end + length > len(data)):
+        raise ValueError('Truncated beacon string')
+    return (data[end:end + length].decode('utf-8'), end + length)
+
+
+def decode(data):
+    """
+    Returns a tuple of (type, beacon) for the packet ``data``, where
+    beacon is None unless type is TYPE_ANNOUNCE.  Packets without the
+    magic are treated as announcements from older peers which only
+    broadcast their station name.  Raises ValueError if the packet is
+    malformed.
+    """
+    if (not data.startswith(MAGIC)):
+        return (TYPE_ANNOUNCE, Beacon(data.decode('utf-8', 'replace')))
+    try:
+        (magic, version, msg_type) = HEADER.unpack(data[:HEADER.size])
+        if (msg_type != TYPE_ANNOUNCE):
+            return (msg_type, None)
+        # Later versions may only append fields, which we ignore
+        offset = HEADER.size + ANNOUNCE.size
+        (flags, port, subscribers, max_subscribers, caps_id, bitrate,
+         load) = ANNOUNCE.unpack(data[HEADER.size:offset])
+        (name, offset) = _string(data, offset, NAME_LENGTH)
+        (codec, offset) = _string(data, offset, CODEC_LENGTH)
+        origin = None
+        if (flags & FLAG_RELAY):
+            (origin, offset) = _string(data, offset, ORIGIN_LENGTH)
+    except struct.error as e:
+        raise ValueError('Truncated beacon: %s' % e)
+    return (msg_type, Beacon(name, port, subscribers, max_subscribers,
+                             codec, caps_id, bitrate, load, flags, origin))
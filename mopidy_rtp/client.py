@@ -0,0 +1,241 @@
+from __future__ import unicode_literals
+
+import logging
+import Queue
+import socket
+import threading
+import time
+
+from mopidy import exceptions
+
+from .session import parse_response
+
+logger = logging.getLogger(__name__)
+
+
+class RtpControlError(exceptions.BackendError):
+    """Base class for all errors raised by :class:`RtpControlClient`"""
+    pass
+
+
+class RtpConnectionError(RtpControlError):
+    """The station could not be reached or dropped the connection"""
+    pass
+
+
+class RtpTimeoutError(RtpControlError):
+    """The station did not answer within the control timeout"""
+    pass
+
+
+class RtpCommandError(RtpControlError):
+    """The station answered with an error response code"""
+    def __init__(self, code):
+        super(RtpCommandError, self).__init__(code)
+        self.code = code
+
+
+class RtpControlClient(object):
+    """
+    Client end of the control protocol terminated by
+    :class:`RtpClientSession`.  A single connection is kept open to
+    the station and re-used for every command.  All socket operations
+    are bounded by ``timeout`` seconds, so a station which disappears
+    costs at most one timeout rather than hanging the caller.  If the
+    station has dropped an idle connection, the command is retried
+    once on a fresh connection.  Commands are blocking, so must never
+    be issued from Mopidy's main loop.  They are issued from both the
+    backend actor and its background worker, so they are serialized.
+    """
+    max_line = 4096
+
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = ''
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        self.close()
+        deadline = time.time() + self.timeout
+        try:
+            self.sock = socket.create_connection((self.host, self.port),
+                                                 self.timeout)
+        except socket.timeout:
+            raise RtpTimeoutError('Timed out connecting to %s:%s' %
+                                  (self.host, self.port))
+        except socket.error as e:
+            raise RtpConnectionError('Unable to connect to %s:%s: %s' %
+                                     (self.host, self.port, e))
+        resp = self._read_line(deadline)
+        logger.debug('Connection Reply: %s', resp)
+
+    def _read_line(self, deadline):
+        while ('\n' not in self.buffer):
+            remaining = deadline - time.time()
+            if (remaining <= 0 or len(self.buffer) > self.max_line):
+                self.close()
+                raise RtpTimeoutError('Timed out waiting for %s:%s' %
+                                      (self.host, self.port))
+            try:
+                self.sock.settimeout(remaining)
+                data = self.sock.recv(1024)
+            except socket.timeout:
+                self.close()
+                raise RtpTimeoutError('Timed out waiting for %s:%s' %
+                                      (self.host, self.port))
+            except socket.error as e:
+                self.close()
+                raise RtpConnectionError('Connection to %s:%s failed: %s' %
+                                         (self.host, self.port, e))
+            if (not data):
+                self.close()
+                raise RtpConnectionError('Connection to %s:%s closed' %
+                                         (self.host, self.port))
+            self.buffer += data
+        (line, self.buffer) = self.buffer.split('\n', 1)
+        return line.rstrip('\r')
+
+    def _transact(self, msg):
+        deadline = time.time() + self.timeout
+        try:
+            self.sock.settimeout(self.timeout)
+            self.sock.sendall(msg + '\n')
+        except socket.error as e:
+            self.close()
+            raise RtpConnectionError('Connection to %s:%s failed: %s' %
+                                     (self.host, self.port, e))
+        return self._read_line(deadline)
+
+    def command(self, msg):
+        """
+        Sends ``msg`` to the station and returns the response
+        parameters as a dictionary.  Raises :class:`RtpCommandError`
+        if the station responds with anything other than ERROR_OK.
+        """
+        with self.lock:
+            if (self.sock is None):
+                self._connect()
+                resp = self._transact(msg)
+            else:
+                try:
+                    resp = self._transact(msg)
+                except RtpConnectionError:
+                    # The station may have timed out our idle connection
+                    self._connect()
+                    resp = self._transact(msg)
+        logger.debug('%s Reply: %s', msg, resp)
+        (code, params) = parse_response(resp)
+        if (code != 'ERROR_OK'):
+            raise RtpCommandError(code)
+        return params
+
+    def close(self):
+        if (self.sock is not None):
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.buffer = ''
+
+
+class RtpSubscription(object):
+    """
+    Client side state of a subscription to a station.  Owns the
+    sockets bound for receiving the station's RTP and RTCP packets,
+    which are handed to :class:`source.RTPSource` through the URI
+    returned by :meth:`source_uri`.
+    """
+    def __init__(self, host, group, port, sock, rtcp_sock, params):
+        self.host = host
+        self.group = group
+        self.port = port
+        self.sock = sock
+        self.rtcp_sock = rtcp_sock
+        self.rtcp = None
+        self.caps = None
+        self.decoder = None
+        self.payload = None
+        self.nack = None
+        self.clock = None
+        self.latency = None
+        self.update(params)
+
+    def update(self, params):
+        """Updates the subscription from a SUBSCRIBE, JOIN, RENEW or CAPS response"""
+        if ('lease' in params):
+            self.lease = int(params['lease'])
+        if ('rtcp' in params):
+            self.rtcp = int(params['rtcp'])
+        if ('caps' in params):
+            self.caps = params['caps']
+        if ('decoder' in params):
+            self.decoder = params['decoder']
+        if ('payload' in params):
+            self.payload = params['payload']
+        if ('nack' in params):
+            self.nack = int(params['nack'])
+        if ('clock' in params):
+            self.clock = params['clock']
+        if ('latency' in params):
+            self.latency = params['latency']
+
+    def source_uri(self):
+        if (self.group):
+            uri = 'rtp://%s:%d' % (self.group, self.port)
+        else:
+            uri = 'rtp://%d' % self.port
+        uri += '?sockfd=%d&rtcpfd=%d' % (self.sock.fileno(),
+                                          self.rtcp_sock.fileno())
+        if (self.rtcp):
+            uri += '&rtcp=%s:%d' % (self.host, self.rtcp)
+        if (self.caps):
+            uri += '&caps=' + self.caps
+        if (self.decoder):
+            uri += '&decoder=' + self.decoder
+        if (self.payload):
+            uri += '&payload=' + self.payload
+        if (self.nack and not self.group):
+            uri += '&nack=%s:%d' % (self.host, self.nack)
+        if (self.clock):
+            uri += '&clock=%s&latency=%s' % (self.clock, self.latency)
+        return uri
+
+    def close(self):
+        self.sock.close()
+        self.rtcp_sock.close()
+
+
+class RtpWorker(object):
+    """
+    Runs control operations, e.g., unsubscribing, one at a time on a
+    background thread in the order they were submitted, so that the
+    caller does not have to wait for stations to answer
+    """
+    def __init__(self, name):
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, fn, *args):
+        self.queue.put((fn, args))
+
+    def _run(self):
+        while (True):
+            job = self.queue.get()
+            if (job is None):
+                return
+            (fn, args) = job
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception('RTP background operation failed')
+
+    def stop(self, timeout=None):
+        """Stops the worker once every operation submitted has run"""
+        self.queue.put(None)
+        self.thread.join(timeout)
@@ -0,0 +1,107 @@
+from __future__ import unicode_literals
+
+import pygst
+pygst.require('0.10')
+import gst  # noqa
+
+# Payload modes selected by the extension's payload property.  Each
+# mode gives the elements which convert raw audio for its payloader,
+# the payloader and depayloader, the elements which decode the
+# depayloaded stream and the RTP caps to assume when the sender has
+# not told us its negotiated caps.  Elements are (factory, properties)
+# and the 'gst' mode's encoder and decoder are configured separately.
+MODES = {
+    # GStreamer specific X-GST payload carrying any encoder's output
+    'gst': {
+        'encoders': [],
+        'payloader': 'rtpgstpay',
+        'depayloader': 'rtpgstdepay',
+        'decoders': [],
+        'caps': None,
+    },
+    # Uncompressed audio (RFC 3551) which costs no encoding CPU but
+    # needs ~1.4Mbps per stream, suited to wired networks
+    'l16': {
+        'encoders': [
+            ('audioconvert', {}),
+            ('audioresample', {}),
+            ('capsfilter', {'caps': gst.Caps(
+                'audio/x-raw-int, endianness=(int)4321, signed=(boolean)true, '
+                'width=(int)16, depth=(int)16, rate=(int)44100, '
+                'channels=(int)2')}),
+        ],
+        'payloader': 'rtpL16pay',
+        'depayloader': 'rtpL16depay',
+        'decoders': [('audioconvert', {})],
+        'caps': 'application/x-rtp, media=(string)audio, '
+                'clock-rate=(int)44100, encoding-name=(string)L16, '
+                'channels=(int)2',
+    },
+    # Low bitrate Opus with in-band forward error correction, suited
+    # to lossy WiFi networks
+    'opus': {
+        'encoders': [
+            ('audioconvert', {}),
+            ('audioresample', {}),
+            ('opusenc', {'bitrate': 96000, 'inband-fec': True,
+                         'packet-loss-percentage': 10}),
+        ],
+        'payloader': 'rtpopuspay',
+        'depayloader': 'rtpopusdepay',
+        'decoders': [('opusdec', {'use-inband-fec': True}),
+                     ('audioconvert', {})],
+        'caps': 'application/x-rtp, media=(string)audio, '
+                'clock-rate=(int)48000, '
+                'encoding-name=(string)X-GST-OPUS-DRAFT-SPITTKA-00',
+    },
+}
+
+# Maps the encoding-name of RTP caps to its payload mode
+ENCODING_NAMES = {
+    'X-GST': 'gst',
+    'L16': 'l16',
+    'OPUS': 'opus',
+    'X-GST-OPUS-DRAFT-SPITTKA-00': 'opus',
+}
+
+
+def _make(specs):
+    elements = []
+    for (factory, props) in specs:
+        e = gst.element_factory_make(factory)
+        for (name, value) in props.items():
+            e.set_property(name, value)
+        elements.append(e)
+    return elements
+
+
+def make_encoders(mode, encoder):
+    """Returns the elements which turn raw audio into payloader input"""
+    if (mode == 'gst'):
+        return [gst.element_factory_make(encoder)]
+    return _make(MODES[mode]['encoders'])
+
+
+def make_payloader(mode):
+    return gst.element_factory_make(MODES[mode]['payloader'])
+
+
+def make_depayloader(mode):
+    return gst.element_factory_make(MODES[mode]['depayloader'])
+
+
+def make_decoders(mode, decoder):
+    """Returns the elements which turn depayloader output into raw audio"""
+    if (mode == 'gst'):
+        return [gst.element_factory_make(decoder)]
+    return _make(MODES[mode]['decoders'])
+
+
+def mode_from_caps(caps):
+    """Returns the payload mode of the RTP caps string ``caps``"""
+    name = gst.Caps(caps)[0]['encoding-name']
+    return ENCODING_NAMES.get(name, 'gst')
+
+
+def default_caps(mode):
+    return MODES[mode]['caps']
@@ -0,0 +1,125 @@
+from __future__ import unicode_literals
+
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Station(object):
+    """
+    A station discovered from its broadcast service information,
+    which is held as a :class:`beacon.Beacon` under ``info``
+    """
+    def __init__(self, addr, info, last_seen):
+        self.addr = addr
+        self.info = info
+        self.last_seen = last_seen
+
+    @property
+    def name(self):
+        return self.info.name
+
+
+class StationRegistry(object):
+    """
+    Keeps track of the stations discovered on the network.  Stations
+    are held in order of when they were last seen, so that expiring
+    those which have not been seen for ``ttl`` seconds only needs to
+    look at the oldest entries.  Listeners registered with
+    :meth:`add_listener` are called without arguments whenever the set
+    of stations, or how any station is listed, changes.
+    """
+    # Stations are listed by load, but only a change of quarter is
+    # worth relisting them for
+    load_bucket = 25
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.stations = collections.OrderedDict()
+        self.listeners = []
+        # Stations are updated from the main loop and read from
+        # the backend's actor thread
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener()
+
+    def __contains__(self, addr):
+        return addr in self.stations
+
+    def __len__(self):
+        return len(self.stations)
+
+    def get(self, addr):
+        return self.stations.get(addr)
+
+    def _listing(self, info):
+        """
+        Returns the parts of ``info`` which change how a station is
+        listed.  Its bitrate and exact load change with almost every
+        announcement, so are left out.
+        """
+        load = info.load
+        if (load is not None):
+            load //= self.load_bucket
+        return (info.name, info.full, info.relay, info.multicast, load)
+
+    def values(self):
+        with self.lock:
+            return list(self.stations.values())
+
+    def update(self, addr, info, now=None):
+        """Records that ``addr`` was seen announcing the beacon ``info``"""
+        if (now is None):
+            now = time.time()
+        with self.lock:
+            station = self.stations.pop(addr, None)
+            changed = (station is None or
+                       self._listing(station.info) != self._listing(info))
+            if (station is None):
+                logger.info('Discovered RTP station %s: %s', addr, info.name)
+                station = Station(addr, info, now)
+            station.info = info
+            station.last_seen = now
+            # Re-insertion moves the station to the most recently seen end
+            self.stations[addr] = station
+        if (changed):
+            self._notify()
+        return station
+
+    def remove(self, addr):
+        with self.lock:
+            station = self.stations.pop(addr, None)
+        if (station is not None):
+            logger.info('Removed RTP station %s', addr)
+            self._notify()
+
+    def expire(self, now=None):
+        """Removes stations not seen within the last ``ttl`` seconds"""
+        if (now is None):
+            now = time.time()
+        expired = False
+        with self.lock:
+            while (self.stations):
+                addr = next(iter(self.stations))
+                if (now - self.stations[addr].last_seen <= self.ttl):
+                    break
+                logger.info('RTP station %s expired', addr)
+                del self.stations[addr]
+                expired = True
+        if (expired):
+            self._notify()
+
+    def clear(self):
+        with self.lock:
+            changed = bool(self.stations)
+            self.stations.clear()
+        if (changed):
+            self._notify()
@@ -0,0 +1,167 @@
+from __future__ import unicode_literals
+
+import collections
+import itertools
+import struct
+import threading
+import time
+
+# RTCP transport layer feedback (RFC 4585) carrying generic NACKs,
+# i.e., version 2 with FMT 1, followed by the sender SSRC, media
+# SSRC and one or more FCI entries of (packet id, bitmask of lost
+# packets following it)
+RTPFB = 205
+FMT_NACK = 1
+NACK_HEADER = struct.Struct(b'!BBHII')
+NACK_FCI = struct.Struct(b'!HH')
+
+
+def rtp_seq(data):
+    """Returns the sequence number of the RTP packet ``data``"""
+    return struct.unpack(b'!H', data[2:4])[0]
+
+
+def encode_nack(ssrc, media_ssrc, seqs):
+    """Returns a generic NACK packet requesting the sequence numbers ``seqs``"""
+    fcis = []
+    for seq in seqs:
+        if (fcis and 0 < (seq - fcis[-1][0]) & 0xffff <= 16):
+            fcis[-1][1] |= 1 << (((seq - fcis[-1][0]) & 0xffff) - 1)
+        else:
+            fcis.append([seq, 0])
+    data = NACK_HEADER.pack(0x80 | FMT_NACK, RTPFB, 2 + len(fcis),
+                            ssrc, media_ssrc)
+    for (pid, blp) in fcis:
+        data += NACK_FCI.pack(pid, blp)
+    return data
+
+
+def decode_nack(data):
+    """
+    Returns the list of sequence numbers requested by the generic NACK
+    packet ``data``.  Raises ValueError if the packet is not one.
+    """
+    if (len(data) < NACK_HEADER.size + NACK_FCI.size):
+        raise ValueError('Truncated NACK')
+    (first, pt, length, ssrc, media_ssrc) = NACK_HEADER.unpack(
+        data[:NACK_HEADER.size])
+    if (first & 0xc0 != 0x80 or first & 0x1f != FMT_NACK or pt != RTPFB):
+        raise ValueError('Not a generic NACK')
+    seqs = []
+    end = min(len(data), (length + 1) * 4)
+    for offset in range(NACK_HEADER.size, end - NACK_FCI.size + 1,
+                        NACK_FCI.size):
+        (pid, blp) = NACK_FCI.unpack(data[offset:offset + NACK_FCI.size])
+        seqs.append(pid)
+        for bit in range(16):
+            if (blp & (1 << bit)):
+                seqs.append((pid + bit + 1) & 0xffff)
+    return seqs
+
+
+def rtp_marker(data):
+    """Returns True if the RTP packet ``data`` has its marker bit set"""
+    return bool(ord(data[1:2]) & 0x80)
+
+
+class PacketHistory(object):
+    """
+    The last ``size`` RTP packets sent, by sequence number, so that
+    packets reported lost by subscribers can be sent again and new
+    subscribers can be sent the most recent packets.  Packets are
+    added from a streaming thread, so access is serialized.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.order = collections.deque()
+        self.packets = {}
+        self.lock = threading.Lock()
+
+    def add(self, data):
+        seq = rtp_seq(data)
+        with self.lock:
+            if (seq not in self.packets):
+                self.order.append(seq)
+            self.packets[seq] = data
+            if (len(self.order) > self.size):
+                self.packets.pop(self.order.popleft(), None)
+
+    def get(self, seq):
+        with self.lock:
+            return self.packets.get(seq)
+
+    def recent(self, n, aligned=False):
+        """
+        Returns up to the last ``n`` packets in the order they were
+        sent.  If ``aligned``, the packets start after one with the
+        marker bit set, i.e., at the start of a payloaded buffer.
+        """
+        with self.lock:
+            seqs = list(itertools.islice(reversed(self.order), n))
+            packets = [self.packets[s] for s in reversed(seqs)]
+        if (aligned):
+            for (i, data) in enumerate(packets):
+                if (rtp_marker(data)):
+                    return packets[i + 1:]
+            return []
+        return packets
+
+    def clear(self):
+        with self.lock:
+            self.order.clear()
+            self.packets.clear()
+
+
+class LossTracker(object):
+    """
+    Detects gaps in the sequence numbers of received RTP packets.
+    Missing packets which arrive within ``deadline`` seconds of their
+    gap being detected are counted as recovered and all others as
+    lost.  A gap of more than ``max_gap`` packets is taken to be a
+    restart of the sender's stream rather than loss.
+    """
+    max_gap = 64
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.highest = None
+        self.missing = collections.OrderedDict()
+        self.requested = 0
+        self.recovered = 0
+        self.lost = 0
+
+    def _expire(self, now):
+        while (self.missing):
+            seq = next(iter(self.missing))
+            if (now - self.missing[seq] < self.deadline):
+                break
+            del self.missing[seq]
+            self.lost += 1
+
+    def received(self, seq):
+        """
+        Records the arrival of packet ``seq`` and returns the list of
+        sequence numbers found to be missing because of it
+        """
+        now = time.time()
+        self._expire(now)
+        if (self.highest is None):
+            self.highest = seq
+            return []
+        delta = (seq - self.highest) & 0xffff
+        if (delta == 0 or delta >= 0x8000):
+            # Duplicate, late or retransmitted packet
+            if (self.missing.pop(seq, None) is not None):
+                self.recovered += 1
+            return []
+        self.highest = seq
+        if (delta == 1):
+            return []
+        if (delta > self.max_gap):
+            self.missing.clear()
+            return []
+        gap = [(seq - i) & 0xffff for i in range(delta - 1, 0, -1)]
+        for s in gap:
+            self.missing[s] = now
+        self.requested += len(gap)
+        return gap
@@ -0,0 +1,163 @@
+from __future__ import unicode_literals
+
+import errno
+import gobject
+import logging
+import socket
+import time
+
+from mopidy.utils import network
+
+from .session import VERSION, handle_command
+
+logger = logging.getLogger(__name__)
+
+
+class _Connection(object):
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        # IPv4 peers appear as IPv4-mapped IPv6 addresses
+        self.host = addr[0].split(':')[-1]
+        self.buffer = b''
+        self.output = b''
+        self.last_active = time.time()
+        self.tags = {}
+
+
+class RtpControlServer(object):
+    """
+    Control server which terminates every connection in the main loop,
+    using non-blocking sockets and IO watches.  Unlike
+    ``network.Server``, which starts an :class:`RtpClientSession`
+    actor and thread for each connection, connecting costs no more
+    than a socket, so a storm of reconnecting clients does not churn
+    threads.  Commands are executed by :func:`session.handle_command`,
+    so both servers speak the same protocol.  Connections which are
+    idle for ``timeout`` seconds are closed.
+    """
+    max_line = 4096
+    max_output = 65536
+    recv_size = 4096
+    backlog = 128
+
+    def __init__(self, backend, hostname, port, max_connections, timeout):
+        self.backend = backend
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.connections = {}
+        self.sock = network.create_socket()
+        self.sock.setblocking(False)
+        self.sock.bind((hostname, port))
+        self.sock.listen(self.backlog)
+        self.tags = [
+            gobject.io_add_watch(self.sock.fileno(), gobject.IO_IN,
+                                 self._on_accept),
+            gobject.timeout_add(int(timeout * 500), self._expire),
+        ]
+
+    def _on_accept(self, fd, condition):
+        while (True):
+            try:
+                (sock, addr) = self.sock.accept()
+            except socket.error as e:
+                if (e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK)):
+                    logger.warn('RTP control accept failed: %s', e)
+                return True
+            if (len(self.connections) >= self.max_connections):
+                logger.warn('Rejected RTP connection from [%s]:%s', *addr[:2])
+                sock.close()
+                continue
+            sock.setblocking(False)
+            conn = _Connection(sock, addr)
+            self.connections[sock.fileno()] = conn
+            conn.tags['in'] = gobject.io_add_watch(
+                sock.fileno(), gobject.IO_IN | gobject.IO_ERR | gobject.IO_HUP,
+                self._on_readable, conn)
+            logger.debug('New RTP connection from [%s]:%s', *addr[:2])
+            self._send(conn, ['OK RTP %s' % VERSION])
+
+    def _on_readable(self, fd, condition, conn):
+        try:
+            data = conn.sock.recv(self.recv_size)
+        except socket.error as e:
+            if (e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)):
+                return True
+            data = None
+        if (not data):
+            self._close(conn)
+            return False
+        conn.last_active = time.time()
+        conn.buffer += data
+        while (b'\n' in conn.buffer):
+            (line, conn.buffer) = conn.buffer.split(b'\n', 1)
+            try:
+                line = line.rstrip(b'\r').decode('utf-8')
+            except UnicodeDecodeError:
+                logger.warning('Closing RTP connection from [%s]:%s which '
+                               'sent invalid data', *conn.addr[:2])
+                self._close(conn)
+                return False
+            logger.debug('Request from [%s]:%s: %s', conn.addr[0],
+                         conn.addr[1], line)
+            self._send(conn, handle_command(self.backend, conn.host, line))
+            if (conn.sock is None):
+                return False
+        if (len(conn.buffer) > self.max_line):
+            self._close(conn)
+            return False
+        return True
+
+    def _send(self, conn, lines):
+        conn.output += ''.join(l + '\n' for l in lines).encode('utf-8')
+        if (len(conn.output) > self.max_output):
+            # The client is not reading its responses
+            self._close(conn)
+            return
+        self._flush(conn)
+
+    def _flush(self, conn):
+        try:
+            sent = conn.sock.send(conn.output)
+        except socket.error as e:
+            if (e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK)):
+                self._close(conn)
+                return
+            sent = 0
+        conn.output = conn.output[sent:]
+        if (conn.output and 'out' not in conn.tags):
+            conn.tags['out'] = gobject.io_add_watch(
+                conn.sock.fileno(), gobject.IO_OUT, self._on_writable, conn)
+
+    def _on_writable(self, fd, condition, conn):
+        self._flush(conn)
+        if (conn.sock is None):
+            return False
+        if (conn.output):
+            return True
+        del conn.tags['out']
+        return False
+
+    def _close(self, conn):
+        if (conn.sock is None):
+            return
+        for tag in conn.tags.values():
+            gobject.source_remove(tag)
+        conn.tags.clear()
+        self.connections.pop(conn.sock.fileno(), None)
+        conn.sock.close()
+        conn.sock = None
+
+    def _expire(self):
+        deadline = time.time() - self.timeout
+        for conn in list(self.connections.values()):
+            if (conn.last_active < deadline):
+                self._close(conn)
+        return True
+
+    def stop(self):
+        for conn in list(self.connections.values()):
+            self._close(conn)
+        for tag in self.tags:
+            gobject.source_remove(tag)
+        self.sock.close()
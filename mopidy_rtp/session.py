@@ -1,23 +1,168 @@
 from __future__ import unicode_literals
 
 import logging
+import time
 
 from mopidy.utils import formatting, network
 
+from .stats import format_stats
+
 logger = logging.getLogger(__name__)
 
-VERSION = '0.0.1'
+VERSION = '0.0.2'
+
+
+def parse_response(line):
+    """
+    Responses take the form "<code> [key=value ...]" so we split
+    the line into the response code and a dictionary of any
+    parameters which follow it
+    """
+    tokens = line.strip().split(' ')
+    params = dict(t.split('=', 1) for t in tokens[1:] if '=' in t)
+    return tokens[0], params
+
+
+def _destinations(tokens):
+    """
+    Returns the (port, rtcp_port) pairs of a SUBSCRIBE command's
+    arguments, where rtcp_port is None unless given.  Either a single
+    "<port> [<rtcp_port>]" is given, or any number of "<port>:<rtcp_port>"
+    entries, since a list of bare ports could not be told apart from a
+    port followed by its RTCP port.  Raises ValueError otherwise.
+    """
+    args = tokens[1:]
+    if (not any(':' in t for t in args)):
+        if (len(args) == 1):
+            return [(int(args[0]), None)]
+        if (len(args) == 2):
+            return [(int(args[0]), int(args[1]))]
+        raise ValueError('Batched SUBSCRIBE entries need an RTCP port')
+    destinations = []
+    for t in args:
+        (port, rtcp_port) = t.split(':', 1)
+        destinations.append((int(port), int(rtcp_port)))
+    return destinations
+
+
+def _execute(backend, host, tokens):
+    lease = backend.config['lease_time']
+    if (len(tokens) >= 2 and tokens[0] == 'SUBSCRIBE'):
+        subscribed = []
+        rejected = []
+        for (port, rtcp_port) in _destinations(tokens):
+            if (backend._start_rtp_session(host, port, rtcp_port)):
+                subscribed.append(str(port))
+            else:
+                rejected.append(str(port))
+        if (not subscribed):
+            return ['ERROR_SUBSCRIBER_LIMIT_REACHED']
+        response = 'ERROR_OK lease=%d %s' % (lease, backend._stream_params())
+        if (len(subscribed) + len(rejected) > 1):
+            response += ' subscribed=' + ','.join(subscribed)
+            if (rejected):
+                response += ' rejected=' + ','.join(rejected)
+        return [response]
+    elif (len(tokens) >= 2 and tokens[0] == 'RENEW'):
+        expired = [t for t in tokens[1:]
+                   if not backend._renew_rtp_session(host, int(t))]
+        if (len(expired) == len(tokens) - 1):
+            return ['ERROR_NOT_SUBSCRIBED']
+        if (expired):
+            return ['ERROR_OK lease=%d expired=%s' % (lease, ','.join(expired))]
+        return ['ERROR_OK lease=%d' % lease]
+    elif (len(tokens) >= 2 and tokens[0] == 'UNSUBSCRIBE'):
+        for port in [int(t) for t in tokens[1:]]:
+            backend._stop_rtp_session(host, port)
+        return ['ERROR_OK']
+    elif (len(tokens) == 1 and tokens[0] == 'JOIN'):
+        group = backend._join_multicast(host)
+        if (group):
+            return ['ERROR_OK group=%s port=%d lease=%d %s' %
+                    (group[0], group[1], lease,
+                     backend._stream_params(multicast=True))]
+        return ['ERROR_MULTICAST_DISABLED']
+    elif (len(tokens) == 1 and tokens[0] == 'RENEW'):
+        if (backend._renew_multicast(host)):
+            return ['ERROR_OK lease=%d' % lease]
+        return ['ERROR_NOT_SUBSCRIBED']
+    elif (len(tokens) == 1 and tokens[0] == 'LEAVE'):
+        backend._leave_multicast(host)
+        return ['ERROR_OK']
+    elif (len(tokens) == 1 and tokens[0] == 'CAPS'):
+        return ['ERROR_OK ' + backend._stream_params()]
+    elif (len(tokens) == 1 and tokens[0] == 'STATS'):
+        return ['ERROR_OK ' + format_stats(backend.get_stats())]
+    return None
+
+
+def handle_command(backend, host, line):
+    """
+    Executes the control command ``line`` received from ``host`` and
+    returns the response lines.  This is shared by every kind of
+    control server, see :class:`RtpClientSession` for the commands.
+    """
+    start = time.time()
+    tokens = line.split(' ')
+    try:
+        response = _execute(backend, host, tokens)
+    except ValueError:
+        response = ['ERROR_INVALID_ARGUMENT']
+    except Exception:
+        # Any other failure is ours, but the client still gets an answer
+        logger.exception('RTP control command failed: %s', line)
+        response = ['ERROR_INTERNAL']
+    if (response is None):
+        response = ['ERROR_UNRECOGNIZED_COMMAND']
+        tokens = ['UNRECOGNIZED']
+
+    # Command latency in ms, by command
+    backend.metrics.observe('control.' + tokens[0].lower(),
+                            (time.time() - start) * 1000)
+    return response
 
 
 class RtpClientSession(network.LineProtocol):
     """
     The RTP client session. Keeps track of a single client session.
     Owing to the simplicity of the protocol, it is also terminated
-    in this class.  Supported commands are:
-    * subscribe <udp_port> - client wishes to subscribe to service
-        to its own IP address on <udp_port> using unicast
-    * unsubscribe <udp_port> - client wishes to unsubscribe from service
-        being received on <udp_port> using unicast
+    in this class, by :func:`handle_command`.  Supported commands are:
+    * subscribe <udp_port> [<rtcp_port>] - client wishes to subscribe
+        to service to its own IP address on <udp_port> using unicast,
+        with RTCP sender reports sent to <rtcp_port> which defaults
+        to <udp_port> + 1.  The response carries the lease time in
+        seconds and the stream parameters, e.g., "ERROR_OK lease=30
+        rtcp=7128 payload=gst caps=<base64> decoder=flacdec", see caps
+        below
+    * subscribe <udp_port>:<rtcp_port> ... - batched form of
+        subscribe for several ports at once, each given with its RTCP
+        port.  The response also lists the ports "subscribed=7000,7002"
+        and any "rejected=7004" for which the subscriber limit was
+        reached
+    * renew [<udp_port> ...] - client wishes to renew the lease on its
+        unicast subscriptions on each <udp_port>, or on its multicast
+        group membership if no port is given.  The response is
+        ERROR_NOT_SUBSCRIBED if every lease has already expired,
+        otherwise any expired ports are listed as "expired=7000"
+    * unsubscribe <udp_port> ... - client wishes to unsubscribe from
+        service being received on each <udp_port> using unicast
+    * join - client wishes to listen to the service's multicast group.
+        The response carries the group address and port, e.g.,
+        "ERROR_OK group=239.255.71.28 port=46988 lease=30 rtcp=7128 ...", or
+        ERROR_MULTICAST_DISABLED if the service only supports unicast
+    * leave - client no longer listens to the service's multicast group
+    * caps - client wishes to know the stream parameters: the UDP port
+        to send RTCP receiver reports to, the payload mode, and once
+        the stream has started, the RTP caps (URL-safe base64 encoded)
+        and, for the gst payload mode, the decoder element to decode
+        them with.  Stations which publish a network clock also give
+        its address as "clock=host:port" and the playback latency (ms)
+        every subscriber should use as "latency=300"
+    * stats - client wishes to read the service's counters and gauges,
+        which are returned as "ERROR_OK key=value key=value ..."
+    Commands with malformed arguments are answered with
+    ERROR_INVALID_ARGUMENT, and commands which fail unexpectedly
+    with ERROR_INTERNAL.
     """
 
     terminator = '\n'
@@ -35,19 +180,7 @@ class RtpClientSession(network.LineProtocol):
     def on_line_received(self, line):
         logger.info('Request from [%s]:%s: %s', self.host, self.port, line)
 
-        tokens = line.split(' ')
-        response = ['ERROR_OK']
-        if (len(tokens) == 2 and tokens[0] == 'SUBSCRIBE'):
-            port = int(tokens[1])
-            host = self.host.split(':')[-1]
-            ret = self.backend._start_rtp_session(host, port)
-            if (not ret):
-                response = ['ERROR_SUBSCRIBER_LIMIT_REACHED']
-        elif (len(tokens) == 2 and tokens[0] == 'UNSUBSCRIBE'):
-            port = int(tokens[1])
-            self.backend._stop_rtp_session(self.host, port)
-        else:
-            response = ['ERROR_UNRECOGNIZED_COMMAND']
+        response = handle_command(self.backend, self.host.split(':')[-1], line)
 
         logger.debug(
             'Response to [%s]:%s: %s', self.host, self.port,
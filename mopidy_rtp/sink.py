@@ -3,54 +3,710 @@ from __future__ import unicode_literals
 import pygst
 pygst.require('0.10')
 import gst  # noqa
+import gobject
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
 
 from mopidy.audio import output
 import logging
 
+from . import payload
+from .retransmit import PacketHistory
+
 logger = logging.getLogger(__name__)
 
-# This variable is a global that is set by the Backend
+# These variables are globals that are set by the Backend
 # during initialization from the extension properties
 encoder = 'identity'
+payload_mode = 'gst'
+fanout = 'multiudpsink'
+rtcp_port = 7128
+# Number of packets kept for retransmission, 0 to disable
+retransmission_history = 0
+# Number of the most recent packets sent to each new subscriber
+fast_join_packets = 0
+# UDP port to publish the pipeline clock on, 0 to disable
+clock_port = 0
+# Packets each subscriber's queue holds in the tee fan-out mode, and
+# which packets a full queue drops, the oldest or newest
+queue_size = 64
+drop_policy = 'old'
+
+# Leaky property of a queue for each drop policy
+LEAKY = {'new': 1, 'old': 2}
+
+# Raw audio handed to an encoding worker process.  Shared memory
+# carries no caps, so both ends agree on them up front, and a restarted
+# worker can pick up the stream at any point without renegotiating.
+WORKER_CAPS = ('audio/x-raw-int, endianness=(int)1234, signed=(boolean)true, '
+               'width=(int)16, depth=(int)16, rate=(int)44100, channels=(int)2')
+
 
+class _ValveSink(gst.Bin):
+    """
+    Common part of :class:`RtpSink` and :class:`RtpWorkerSink`.  Audio
+    enters through a valve, which discards it while there is no
+    destination, followed by a leaky queue, so that a stalled encoder
+    or network drops audio rather than holding up Mopidy's own
+    playback.  Subclasses link the rest of their chain to ``queue``,
+    extend :meth:`_activate` and :meth:`_deactivate`, which run when
+    the first destination is added and the last one removed, and
+    implement :meth:`_add_destination` and :meth:`_remove_destination`.
+    While ``relaying``, the valve stays closed whatever the
+    destinations.
+    """
+    # Prefix of the counters of the queue
+    queue_counters = 'queue.'
 
-class RtpSink(gst.Bin):
     def __init__(self):
-        super(RtpSink, self).__init__()
-        # These elements are 'always on' even if nobody is
-        # subscribed to listen.  It streamlines the process
-        # of adding/removing listeners.
-        queue = gst.element_factory_make('queue')
-        rate = gst.element_factory_make('audiorate')
-        enc = gst.element_factory_make(encoder)
-        pay = gst.element_factory_make('rtpgstpay')
-        # Re-use of the audio output bin which handles
-        # dynamic element addition/removal nicely
-        self.tee = output.AudioOutput()
-        self.add_many(queue, rate, enc, pay, self.tee)
-        gst.element_link_many(queue, rate, enc, pay, self.tee)
-        pad = queue.get_pad('sink')
+        super(_ValveSink, self).__init__()
+        self.valve = gst.element_factory_make('valve')
+        self.valve.set_property('drop', True)
+        self.queue = gst.element_factory_make('queue')
+        self.queue.set_property('leaky', LEAKY[drop_policy])
+        self.queue.connect('overrun', self._on_overrun)
+        self.add_many(self.valve, self.queue)
+        self.valve.link(self.queue)
+        self.segment = None
+        self.relaying = False
+        # Counters reported by get_counters()
+        self.counters = {self.queue_counters + 'drops': 0}
+        # Destination table indexed by ident, which makes
+        # subscriber addition/removal O(1)
+        self.destinations = {}
+        pad = self.valve.get_pad('sink')
+        pad.add_event_probe(self._on_event)
         ghost_pad = gst.GhostPad('sink', pad)
         self.add_pad(ghost_pad)
 
-    def add(self, host, port):
+    def _on_event(self, pad, event):
+        # The valve discards events while closed, so keep hold of
+        # the current segment to replay when it opens
+        if (event.type == gst.EVENT_NEWSEGMENT):
+            self.segment = event
+        return True
+
+    def _on_overrun(self, queue):
+        self.counters[self.queue_counters + 'drops'] += 1
+
+    def _activate(self):
+        if (self.segment is not None):
+            self.queue.get_pad('sink').send_event(self.segment)
+        self.valve.set_property('drop', False)
+
+    def _deactivate(self):
+        self.valve.set_property('drop', True)
+
+    @staticmethod
+    def _ident(host, port):
+        return str(port) + '@' + host
+
+    def add(self, host, port, rtcp=None):
+        """
+        Starts streaming to ``host`` on UDP ``port``, with RTCP sender
+        reports going to UDP port ``rtcp`` which defaults to port + 1
+        """
+        ident = self._ident(host, port)
+        if (ident in self.destinations):
+            return
+        if (rtcp is None):
+            rtcp = port + 1
+        if (not self.destinations and not self.relaying):
+            self._activate()
+        self._add_destination(ident, host, port, rtcp)
+        self.destinations[ident] = (host, port, rtcp)
+
+    def remove(self, host, port):
+        ident = self._ident(host, port)
+        if (ident not in self.destinations):
+            return
+        (host, port, rtcp) = self.destinations.pop(ident)
+        self._remove_destination(ident, host, port, rtcp)
+        if (not self.destinations and not self.relaying):
+            self._deactivate()
+
+    def _add_destination(self, ident, host, port, rtcp):
+        raise NotImplementedError
+
+    def _remove_destination(self, ident, host, port, rtcp):
+        raise NotImplementedError
+
+    def get_counters(self):
+        """
+        Returns a dictionary of counters and gauges, keyed by dotted name
+        """
+        counters = dict(self.counters)
+        counters[self.queue_counters + 'level'] = \
+            self.queue.get_property('current-level-buffers')
+        counters['destinations'] = len(self.destinations)
+        return counters
+
+
+class RtpSink(_ValveSink):
+    """
+    Encodes and payloads the audio stream once, using the payload
+    mode's elements from :mod:`payload`, and fans the resulting
+    RTP packets out to every subscriber.  Two fan-out modes exist:
+    * multiudpsink - a single sender keeps a table of destinations
+        and each payloaded packet is simply sent to every destination
+        in turn.  Adding a listener costs one extra ``sendto`` per
+        packet and no extra thread or buffer copy.
+    * tee - each subscriber gets its own queue and udpsink hanging off
+        a tee, i.e., its own streaming thread.  Queues are bounded and
+        leaky, so a subscriber which falls behind only ever loses its
+        own packets rather than holding up every other subscriber.
+    The encoding chain is only running while there is at least one
+    destination.  Otherwise the valve discards the audio and the chain
+    is held in the NULL state, so an idle station costs no more than
+    a plain Mopidy install.
+    Packets pass through an RTP session manager which sends RTCP
+    sender reports to every destination and receives their receiver
+    reports on ``rtcp_port``, from which :meth:`get_stats` derives
+    per-destination quality statistics.
+    When retransmission or fast join is enabled, the most recent
+    packets are kept so that :meth:`retransmit` can resend those a
+    subscriber lost, and :meth:`fast_join` can send a burst of them to
+    a new subscriber.
+    When ``clock_port`` is set, the pipeline's clock is published as
+    a network clock, to which receivers slave their own pipelines.
+    In relay mode, RTP packets received from another station are
+    passed to :meth:`relay` and sent on to every destination as they
+    are, in place of the encoded stream, which is then shut down.
+    """
+    # Time to wait after closing the valve before releasing the
+    # encoding chain, so that any buffer already in flight has
+    # left the valve
+    release_delay = 0.1
+    # Time after the last relayed packet before the encoded stream
+    # takes over again
+    relay_timeout = 1.0
+
+    def __init__(self):
+        super(RtpSink, self).__init__()
+        rate = gst.element_factory_make('audiorate')
+        encoders = payload.make_encoders(payload_mode, encoder)
+        pay = payload.make_payloader(payload_mode)
+        self.rtpbin = gst.element_factory_make('gstrtpbin')
+        self.rtcpsink = gst.element_factory_make('multiudpsink')
+        self.rtcpsink.set_property('sync', False)
+        self.rtcpsink.set_property('async', False)
+        # Receiver reports are read from a plain socket and pushed into
+        # the session, since a live udpsrc would make Mopidy's whole
+        # pipeline live, i.e., unable to preroll on pause or seek
+        self.rtcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rtcp_sock.bind(('', rtcp_port))
+        rtcpsrc = gst.element_factory_make('appsrc')
+        rtcpsrc.set_property('caps', gst.Caps('application/x-rtcp'))
+        rtcpsrc.set_property('format', gst.FORMAT_TIME)
+        self.rtcpsrc = rtcpsrc
+        self.rtcp_tag = gobject.io_add_watch(self.rtcp_sock.fileno(),
+                                             gobject.IO_IN, self._on_rtcp)
+        # The encoding chain is locked in the NULL state until the
+        # first destination is added
+        self.chain = [self.queue, rate] + encoders + [pay, rtcpsrc]
+        for e in self.chain:
+            e.set_locked_state(True)
+        self.release_tag = None
+        # Total payloaded bytes, from which the bitrate is measured
+        self.bytes_sent = 0
+        pay.get_pad('src').add_buffer_probe(self._on_payload)
+        # The RTP caps negotiated by the payloader, which receivers
+        # need in order to decode the stream
+        self.caps = None
+        pay.get_pad('src').connect('notify::caps', self._on_caps)
+        self.counters.update({'encoder.buffers': 0, 'encoder.bytes': 0,
+                              'relay.packets': 0})
+        encoders[-1].get_pad('src').add_buffer_probe(self._on_encoded)
+        self.pay = pay
+        # Queues and counters of each tee branch by ident
+        self.branches = {}
+        # Every RTP packet goes out of this one socket, i.e., from the
+        # same source port, since receivers drop packets of an SSRC
+        # which arrive from a second address as a collision.  The
+        # fan-out sends the live stream through it, and so do
+        # retransmissions, fast join bursts and relayed packets.
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', 0))
+        if (fanout == 'tee'):
+            # Re-use of the audio output bin which handles
+            # dynamic element addition/removal nicely
+            self.fanout = output.AudioOutput()
+        else:
+            self.fanout = gst.element_factory_make('multiudpsink')
+            self.fanout.set_property('sockfd', self.sock.fileno())
+            self.fanout.set_property('closefd', False)
+            # Sync must be true to avoid seek timestamp sync
+            # problems.  The sink exists before any buffers flow
+            # through the valve so it must not hold up preroll.
+            self.fanout.set_property('sync', True)
+            self.fanout.set_property('async', False)
+        self.add_many(self.rtpbin, self.fanout, self.rtcpsink,
+                      *self.chain[1:])
+        gst.element_link_many(self.queue, rate, *(encoders + [pay]))
+        pay.link_pads('src', self.rtpbin, 'send_rtp_sink_0')
+        self.rtpbin.link_pads('send_rtp_src_0', self.fanout, 'sink')
+        self.rtpbin.link_pads('send_rtcp_src_0', self.rtcpsink, 'sink')
+        rtcpsrc.link_pads('src', self.rtpbin, 'recv_rtcp_sink_0')
+        self.history = None
+        if (retransmission_history or fast_join_packets):
+            self.history = PacketHistory(max(retransmission_history,
+                                             fast_join_packets))
+            self.rtpbin.get_pad('send_rtp_src_0').add_buffer_probe(
+                self._on_send)
+        if (retransmission_history):
+            self.counters.update({'retransmission.requested': 0,
+                                  'retransmission.sent': 0})
+        if (fast_join_packets):
+            self.counters.update({'fast_join.bursts': 0,
+                                  'fast_join.packets': 0})
+        self.relay_tag = None
+        self.last_relay = 0
+        self.clock_provider = None
+        self.clock_checked = False
+
+    def _on_rtcp(self, fd, condition):
+        try:
+            data = self.rtcp_sock.recv(65536)
+        except socket.error as e:
+            logger.debug('Failed to receive RTCP: %s', e)
+            return True
+        # Reports are only of interest while the session is running
+        if (not self.rtcpsrc.get_locked_state()):
+            self.rtcpsrc.emit('push-buffer', gst.Buffer(data))
+        return True
+
+    def _on_payload(self, pad, buf):
+        self.bytes_sent += buf.size
+        if (clock_port and not self.clock_checked):
+            # The pipeline has selected its clock once data flows
+            self.clock_checked = True
+            gobject.idle_add(self._publish_clock)
+        return True
+
+    def _publish_clock(self):
+        clock = self.get_clock() or gst.system_clock_obtain()
+        provider = self.clock_provider
+        if (provider is None or provider.get_property('clock') != clock):
+            # Only one provider can be bound to the port at a time
+            self.clock_provider = provider = None
+            self.clock_provider = gst.NetTimeProvider(clock, None, clock_port)
+            logger.info('RTP clock %s published on port %d', clock.get_name(),
+                        clock_port)
+        return False
+
+    def _on_send(self, pad, buf):
+        self.history.add(buf.data)
+        return True
+
+    def _on_caps(self, pad, pspec):
+        caps = pad.get_negotiated_caps()
+        if (caps is None):
+            return
+        # Fields which are specific to this run of the payloader
+        # would be wrong for receivers joining a later run
+        caps = caps.copy()
+        for field in ('ssrc', 'clock-base', 'seqnum-base'):
+            if (caps[0].has_field(field)):
+                caps[0].remove_field(field)
+        self.caps = caps.to_string()
+        logger.debug('RTP caps negotiated: %s', self.caps)
+
+    def _on_encoded(self, pad, buf):
+        self.counters['encoder.buffers'] += 1
+        self.counters['encoder.bytes'] += buf.size
+        return True
+
+    def _on_branch_overrun(self, queue, ident):
+        self.branches[ident][1]['drops'] += 1
+
+    def _on_branch_buffer(self, pad, buf, ident):
+        counters = self.branches[ident][1]
+        counters['packets_sent'] += 1
+        counters['bytes_sent'] += buf.size
+        return True
+
+    def _activate(self):
+        if (self.release_tag is not None):
+            # The chain was never released so just reopen the valve
+            gobject.source_remove(self.release_tag)
+            self.release_tag = None
+            self.valve.set_property('drop', False)
+            return
+        # Restarting the chain from NULL means the encoder emits a
+        # fresh stream header for the first subscriber
+        for e in reversed(self.chain):
+            e.set_locked_state(False)
+            e.sync_state_with_parent()
+        super(RtpSink, self)._activate()
+        self.clock_checked = False
+        logger.debug('RTP encoding chain started')
+
+    def _deactivate(self):
+        super(RtpSink, self)._deactivate()
+        self.release_tag = gobject.timeout_add(int(self.release_delay * 1000),
+                                               self._release)
+
+    def _release(self):
+        self.release_tag = None
+        for e in self.chain:
+            e.set_locked_state(True)
+            e.set_state(gst.STATE_NULL)
+        # The next run of the chain starts a new stream
+        if (self.history is not None):
+            self.history.clear()
+        logger.debug('RTP encoding chain released')
+        return False
+
+    def _add_branch(self, ident, host, port):
         b = gst.Bin()
         queue = gst.element_factory_make('queue')
+        queue.set_property('max-size-buffers', queue_size)
+        queue.set_property('max-size-bytes', 0)
+        queue.set_property('max-size-time', 0)
+        queue.set_property('leaky', LEAKY[drop_policy])
         udpsink = gst.element_factory_make('udpsink')
         udpsink.set_property('host', host)
         udpsink.set_property('port', port)
+        udpsink.set_property('sockfd', self.sock.fileno())
+        udpsink.set_property('closefd', False)
         # Both async and sync must be true to avoid seek
         # timestamp sync problems
-        udpsink.set_property('sync', True)    
+        udpsink.set_property('sync', True)
         udpsink.set_property('async', True)
+        self.branches[ident] = (queue, {'packets_sent': 0, 'bytes_sent': 0,
+                                        'drops': 0})
+        # A leaky queue overruns each time it drops packets
+        queue.connect('overrun', self._on_branch_overrun, ident)
+        udpsink.get_pad('sink').add_buffer_probe(self._on_branch_buffer, ident)
         b.add_many(queue, udpsink)
         gst.element_link_many(queue, udpsink)
         pad = queue.get_pad('sink')
         ghost_pad = gst.GhostPad('sink', pad)
         b.add_pad(ghost_pad)
-        ident = str(port) + '@' + host
-        self.tee.add_sink(ident, b)
+        self.fanout.add_sink(ident, b)
 
-    def remove(self, host, port):
-        ident = str(port) + '@' + host
-        self.tee.remove_sink(ident)
+    def _add_destination(self, ident, host, port, rtcp):
+        if (fanout == 'tee'):
+            self._add_branch(ident, host, port)
+        else:
+            self.fanout.emit('add', host, port)
+        self.rtcpsink.emit('add', host, rtcp)
+
+    def _remove_destination(self, ident, host, port, rtcp):
+        if (fanout == 'tee'):
+            self.fanout.remove_sink(ident)
+            del self.branches[ident]
+        else:
+            self.fanout.emit('remove', host, port)
+        self.rtcpsink.emit('remove', host, rtcp)
+
+    def fast_join(self, host, port):
+        """
+        Sends the most recent packets to ``host`` on UDP ``port``, so
+        that a new subscriber's jitter buffer fills straight away
+        rather than at the rate of the live stream.  Should be called
+        before :meth:`add`, so the burst arrives ahead of live packets.
+        X-GST bursts start at a payloaded buffer boundary, so the
+        decoder never sees a partial buffer.
+        """
+        streaming = self.relaying or (self.destinations and
+                                      self.release_tag is None)
+        if (not fast_join_packets or not streaming):
+            # Nothing is being sent, so there is nothing recent
+            return
+        packets = self.history.recent(fast_join_packets,
+                                      aligned=(payload_mode == 'gst'))
+        try:
+            for data in packets:
+                self.sock.sendto(data, (host, port))
+        except socket.error as e:
+            logger.debug('Failed to send fast join burst to %s:%s: %s',
+                         host, port, e)
+            return
+        self.counters['fast_join.bursts'] += 1
+        self.counters['fast_join.packets'] += len(packets)
+
+    def relay(self, data):
+        """
+        Sends the RTP packet ``data``, received from another station,
+        to every destination.  May be called from any thread.
+        """
+        self.last_relay = time.time()
+        if (not self.relaying):
+            if (self.relay_tag is None):
+                self.relay_tag = gobject.idle_add(self._start_relay)
+            return
+        self.bytes_sent += len(data)
+        self.counters['relay.packets'] += 1
+        if (self.history is not None):
+            self.history.add(data)
+        for (host, port, rtcp) in self.destinations.values():
+            try:
+                self.sock.sendto(data, (host, port))
+            except socket.error as e:
+                logger.debug('Failed to relay to %s:%s: %s', host, port, e)
+
+    def _start_relay(self):
+        self.relaying = True
+        if (self.destinations and self.release_tag is None):
+            self._deactivate()
+        if (self.history is not None):
+            self.history.clear()
+        self.relay_tag = gobject.timeout_add(int(self.relay_timeout * 1000),
+                                             self._check_relay)
+        logger.info('RTP sink relaying received stream')
+        return False
+
+    def _check_relay(self):
+        if (time.time() - self.last_relay < self.relay_timeout):
+            return True
+        self.relaying = False
+        self.relay_tag = None
+        if (self.history is not None):
+            self.history.clear()
+        if (self.destinations):
+            self._activate()
+        logger.info('RTP sink stopped relaying')
+        return False
+
+    def retransmit(self, seqs):
+        """
+        Returns the packets still held for the sequence numbers
+        ``seqs``, for sending again to a subscriber which lost them
+        """
+        self.counters['retransmission.requested'] += len(seqs)
+        packets = [p for p in (self.history.get(s) for s in seqs) if p]
+        self.counters['retransmission.sent'] += len(packets)
+        return packets
+
+    def get_drops(self):
+        """
+        Returns a dictionary of the packets each destination's queue
+        has dropped, keyed by (host, port).  Destinations only have
+        their own queue in the tee fan-out mode.
+        """
+        return dict(((host, port), self.branches[ident][1]['drops'])
+                    for (ident, (host, port, rtcp)) in self.destinations.items()
+                    if ident in self.branches)
+
+    def get_counters(self):
+        """
+        Returns a dictionary of counters and gauges for the encoder,
+        the encoding queue and each destination, keyed by dotted name
+        """
+        counters = super(RtpSink, self).get_counters()
+        for (ident, (host, port, rtcp)) in self.destinations.items():
+            prefix = 'subscriber.%s.' % ident
+            if (fanout == 'tee'):
+                (queue, branch) = self.branches[ident]
+                counters[prefix + 'queue_level'] = \
+                    queue.get_property('current-level-buffers')
+                for (name, value) in branch.items():
+                    counters[prefix + name] = value
+            else:
+                # Returns bytes sent, packets sent, connect and disconnect times
+                values = self.fanout.emit('get-stats', host, port)
+                counters[prefix + 'bytes_sent'] = values[0]
+                counters[prefix + 'packets_sent'] = values[1]
+        return counters
+
+    def get_stats(self):
+        """
+        Returns a dictionary of the latest receiver report from each
+        host, giving its fraction of packets lost, cumulative packets
+        lost, interarrival jitter (ms) and round trip time (ms)
+        """
+        stats = {}
+        session = self.rtpbin.emit('get-internal-session', 0)
+        if (session is None):
+            return stats
+        for source in session.get_property('sources'):
+            s = source.get_property('stats')
+            if (s['internal'] or not s.has_field('have-rb') or
+                not s['have-rb'] or not s.has_field('rtcp-from')):
+                continue
+            host = s['rtcp-from'].rsplit(':', 1)[0]
+            clock_rate = s['clock-rate'] if s['clock-rate'] > 0 else 90000
+            stats[host] = {
+                'fraction_lost': s['rb-fractionlost'] / 256.0,
+                'packets_lost': s['rb-packetslost'],
+                'jitter': s['rb-jitter'] * 1000.0 / clock_rate,
+                # Round trip time is in units of 1/65536 seconds
+                'round_trip': s['rb-round-trip'] * 1000.0 / 65536,
+            }
+        return stats
+
+    def close(self):
+        gobject.source_remove(self.rtcp_tag)
+        self.rtcp_sock.close()
+        self.sock.close()
+
+
+class RtpWorkerSink(_ValveSink):
+    """
+    Counterpart of :class:`RtpSink` which runs the encoding, payloading
+    and fan-out in a worker process, see :mod:`worker`, so encoding
+    is scheduled on another core and a crashing codec does not take
+    Mopidy down with it.  Raw audio reaches the worker through shared
+    memory, destinations are passed to it on its stdin, and it reports
+    the negotiated caps and its counters on its stdout.  The worker is
+    restarted if it exits, and every destination is added to it again.
+    Retransmission and relaying need the packets in this process, so
+    are not supported, and neither are per-destination queues.
+    """
+    # Shared memory between the processes, enough for ~5s of audio
+    shm_size = 1 << 20
+    # Time to wait before restarting a worker which has exited
+    restart_delay = 1.0
+    # The worker reports the counters of its own queue
+    queue_counters = 'worker.queue.'
+
+    def __init__(self):
+        super(RtpWorkerSink, self).__init__()
+        convert = gst.element_factory_make('audioconvert')
+        resample = gst.element_factory_make('audioresample')
+        capsfilter = gst.element_factory_make('capsfilter')
+        capsfilter.set_property('caps', gst.Caps(WORKER_CAPS))
+        # A private directory, as a predictable path in a shared one
+        # could be taken over by another user
+        self.socket_dir = tempfile.mkdtemp(prefix='mopidy-rtp-')
+        self.socket_path = os.path.join(self.socket_dir, 'audio')
+        shmsink = gst.element_factory_make('shmsink')
+        shmsink.set_property('socket-path', self.socket_path)
+        shmsink.set_property('shm-size', self.shm_size)
+        shmsink.set_property('wait-for-connection', False)
+        shmsink.set_property('sync', False)
+        shmsink.set_property('async', False)
+        self.add_many(convert, resample, capsfilter, shmsink)
+        gst.element_link_many(self.queue, convert, resample, capsfilter,
+                              shmsink)
+        # State reported by the worker
+        self.caps = None
+        self.bytes_sent = 0
+        self.stats = {}
+        self.drops = {}
+        self.restarts = 0
+        self.process = None
+        self.buffer = b''
+        self.output_tag = None
+        self.closed = False
+        self._start_worker()
+
+    def _start_worker(self):
+        args = [sys.executable, '-m', 'mopidy_rtp.worker',
+                '--socket', self.socket_path,
+                '--encoder', encoder,
+                '--payload', payload_mode,
+                '--fanout', fanout,
+                '--rtcp-port', str(rtcp_port),
+                '--queue-size', str(queue_size),
+                '--drop-policy', drop_policy,
+                '--fast-join', str(fast_join_packets),
+                '--clock-port', str(clock_port)]
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=True)
+        self.buffer = b''
+        self.output_tag = gobject.io_add_watch(
+            self.process.stdout.fileno(),
+            gobject.IO_IN | gobject.IO_ERR | gobject.IO_HUP,
+            self._on_worker_output)
+        gobject.child_watch_add(self.process.pid, self._on_worker_exit)
+        for (host, port, rtcp) in self.destinations.values():
+            self._send('ADD %s %d %d' % (host, port, rtcp))
+        logger.info('RTP encoding worker started, pid %d', self.process.pid)
+        return False
+
+    def _on_worker_exit(self, pid, status):
+        if (self.output_tag is not None):
+            gobject.source_remove(self.output_tag)
+            self.output_tag = None
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process = None
+        if (self.closed):
+            return
+        logger.warning('RTP encoding worker exited with status %d, '
+                       'restarting', status)
+        self.restarts += 1
+        # The restarted worker negotiates its stream afresh
+        self.caps = None
+        gobject.timeout_add(int(self.restart_delay * 1000), self._start_worker)
+
+    def _on_worker_output(self, fd, condition):
+        data = os.read(fd, 65536)
+        if (not data):
+            self.output_tag = None
+            return False
+        self.buffer += data
+        while (b'\n' in self.buffer):
+            (line, self.buffer) = self.buffer.split(b'\n', 1)
+            (kind, _, value) = line.decode('utf-8').partition(' ')
+            if (kind == 'CAPS'):
+                self.caps = value
+                logger.debug('RTP caps negotiated: %s', self.caps)
+            elif (kind == 'STATS'):
+                report = json.loads(value)
+                self.bytes_sent = report['bytes_sent']
+                self.stats = report['stats']
+                self.drops = dict(((host, port), drops)
+                                  for (host, port, drops) in report['drops'])
+                self.counters.update(report['counters'])
+        return True
+
+    def _send(self, line):
+        if (self.process is None):
+            # The destinations are sent again once the worker restarts
+            return
+        try:
+            self.process.stdin.write(line.encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+        except IOError as e:
+            logger.debug('Failed to send to RTP encoding worker: %s', e)
+
+    def _add_destination(self, ident, host, port, rtcp):
+        self._send('ADD %s %d %d' % (host, port, rtcp))
+
+    def _remove_destination(self, ident, host, port, rtcp):
+        self._send('REMOVE %s %d' % (host, port))
+
+    def fast_join(self, host, port):
+        """Asks the worker to send ``host`` a fast join burst on ``port``"""
+        if (fast_join_packets):
+            self._send('FAST_JOIN %s %d' % (host, port))
+
+    def relay(self, data):
+        # Relaying is not supported by the worker
+        pass
+
+    def retransmit(self, seqs):
+        # The packets sent are only held by the worker
+        return []
+
+    def get_drops(self):
+        return dict(self.drops)
+
+    def get_counters(self):
+        """
+        Returns the counters last reported by the worker, with the
+        destinations and worker restarts as seen from this process
+        """
+        counters = super(RtpWorkerSink, self).get_counters()
+        counters['worker.restarts'] = self.restarts
+        return counters
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    def close(self):
+        """Stops the worker, which exits once its stdin is closed"""
+        self.closed = True
+        if (self.process is not None):
+            self.process.stdin.close()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
@@ -5,14 +5,50 @@ import gobject
 
 gobject.threads_init ()
 
+import base64
 import logging
+import random
+import socket
+import struct
+import weakref
+
+from . import payload
+from .retransmit import LossTracker, encode_nack, rtp_seq
 
 logger = logging.getLogger(__name__)
 
+# Every RTPSource which has been given a URI, so that the backend
+# can collect their statistics
+instances = weakref.WeakSet()
+
 # These variables are globals that is set by the Backend
 # during initialization from the extension properties
 caps_string = 'YXVkaW8veC1yYXctaW50LCBlbmRpYW5uZXNzPShpbnQpMTIzNCwgc2lnbmVkPShib29sZWFuKXRydWUsIHdpZHRoPShpbnQpMTYsIGRlcHRoPShpbnQpMTYsIHJhdGU9KGludCk0NDEwMCwgY2hhbm5lbHM9KGludCky,' 
 decoder = 'identity'
+# Jitter buffer latency (ms), whether to drop packets which arrive
+# later than that, and socket receive buffer size (bytes, 0 for the
+# system default)
+latency = 200
+drop_on_latency = False
+receive_buffer_size = 0
+# Called with every RTP packet received when the backend relays
+# received streams
+relay = None
+# Seconds between measurements of the offset from a sender's clock
+sync_check_period = 5.0
+
+# A GstNetTimePacket of the local and remote clock times (ns)
+NET_TIME_PACKET = struct.Struct(b'!QQ')
+
+# Latency profiles selected by the extension's latency_profile property
+# as a tuple of (latency, drop_on_latency, receive_buffer_size)
+PROFILES = {
+    # Wired networks with little jitter
+    'lan': (40, True, 65536),
+    'default': (200, False, 0),
+    # Lossy WiFi networks where packets may arrive in bursts
+    'wifi': (500, False, 524288),
+}
 
 
 class RTPSource(gst.Bin, gst.URIHandler):
@@ -21,35 +57,298 @@ class RTPSource(gst.Bin, gst.URIHandler):
                       'RTP peer-to-peer audio streaming URIHandler element',
                       'Liam Wickins')
 
+    rtpbin = None
+    packets_in = 0
+    packets_out = 0
+    loss = None
+    clock = None
+    sync_error = None
+    clock_round_trip = None
+
     @staticmethod
     def _parse_uri(uri):
-        """The URI takes the form rtp://port and we grab the port from here"""
-        return int(uri.split('/')[-1])
-
-    def _launch_rtp_bin(self, port):
-        # The capstring is a configured property of the extension
-        caps = '''application/x-rtp,
-            media=(string)application,
-            clock-rate=(int)90000,
-            encoding-name=(string)X-GST,
-            caps=(string)'''
-        # Append the actual caps string configured
-        caps += str(caps_string)
+        """
+        The URI takes the form rtp://port for a unicast stream or
+        rtp://group:port for a multicast stream, optionally followed
+        by query parameters, e.g., rtp://port?sockfd=fd when the
+        client has already bound the receive socket.  Supported
+        parameters are:
+        * sockfd - socket to receive RTP on
+        * rtcpfd - socket to receive RTCP on, otherwise port + 1
+        * rtcp - host:port to send RTCP receiver reports to
+        * caps - URL-safe base64 encoded RTP caps negotiated by the
+            sender, otherwise the configured caps are used
+        * decoder - decoder element to use for the gst payload mode,
+            otherwise the configured decoder is used
+        * payload - the sender's payload mode, see :mod:`payload`,
+            when it has not sent its caps.  Defaults to gst.
+        * nack - host:port to send NACKs for lost packets to, from
+            the socket given by sockfd, so that the sender can
+            retransmit them
+        * clock - host:port of the sender's network clock, which the
+            pipeline is slaved to so that every receiver plays in sync
+        * latency - target latency (ms) shared by every receiver of a
+            synchronized stream, otherwise the configured latency
+        We return a
+        tuple of (group, port, params) where group is None for unicast.
+        """
+        location = uri.split('/')[-1]
+        params = {}
+        if ('?' in location):
+            (location, query) = location.split('?', 1)
+            params = dict(p.split('=', 1) for p in query.split('&') if '=' in p)
+        if (':' in location):
+            (group, port) = location.rsplit(':', 1)
+            return (group, int(port), params)
+        return (None, int(location), params)
+
+    @staticmethod
+    def _peer_decoder(name):
+        """
+        Returns the decoder named by the sender if it is a decoder
+        element, otherwise the configured decoder, since the name
+        comes from the network
+        """
+        factory = gst.element_factory_find(name)
+        if (factory is None or 'Decoder' not in factory.get_klass()):
+            logger.warn('Ignoring RTP decoder %s named by sender', name)
+            return decoder
+        return name
+
+    def _launch_rtp_bin(self, group, port, params):
+        if ('caps' in params):
+            # The sender told us exactly which caps it is sending
+            caps = base64.urlsafe_b64decode(str(params['caps']))
+            mode = payload.mode_from_caps(caps)
+        elif (params.get('payload', 'gst') != 'gst'):
+            # Standard payloads have well known caps
+            mode = params['payload']
+            caps = payload.default_caps(mode)
+        else:
+            mode = 'gst'
+            # The capstring is a configured property of the extension
+            caps = '''application/x-rtp,
+                media=(string)application,
+                clock-rate=(int)90000,
+                encoding-name=(string)X-GST,
+                caps=(string)'''
+            # Append the actual caps string configured
+            caps += str(caps_string)
+        dec_name = decoder
+        if ('decoder' in params):
+            dec_name = self._peer_decoder(params['decoder'])
         logger.debug('Using caps: %s', caps)
-        logger.debug('Using decoder: %s', decoder)
+        logger.debug('Using payload mode: %s', mode)
+        logger.debug('Using decoder: %s', dec_name)
         udpsrc = gst.element_factory_make('udpsrc')
-        jitbuf = gst.element_factory_make('gstrtpjitterbuffer')
-        depay = gst.element_factory_make('rtpgstdepay')
-        dec = gst.element_factory_make(decoder)
+        rtcpsrc = gst.element_factory_make('udpsrc')
+        self.rtpbin = gst.element_factory_make('gstrtpbin')
+        self.depay = payload.make_depayloader(mode)
+        decoders = payload.make_decoders(mode, dec_name)
         udpsrc.set_property('port', port)
+        if ('sockfd' in params):
+            # The socket is owned by the client which bound it, and
+            # has already joined any multicast group
+            udpsrc.set_property('sockfd', int(params['sockfd']))
+            udpsrc.set_property('closefd', False)
+            udpsrc.set_property('auto-multicast', False)
+        elif (group):
+            # Joins the multicast group when the source starts
+            udpsrc.set_property('multicast-group', group)
+            udpsrc.set_property('auto-multicast', True)
         udpsrc.set_property('caps', gst.Caps(caps))
-        jitbuf.set_property('mode', 0)
-        self.add_many(udpsrc, jitbuf, depay, dec)
-        gst.element_link_many(udpsrc, jitbuf, depay, dec)
-        pad = dec.get_pad('src')
+        if ('rtcpfd' in params):
+            rtcpsrc.set_property('sockfd', int(params['rtcpfd']))
+            rtcpsrc.set_property('closefd', False)
+            rtcpsrc.set_property('auto-multicast', False)
+        else:
+            rtcpsrc.set_property('port', port + 1)
+            if (group):
+                rtcpsrc.set_property('multicast-group', group)
+        rtcpsrc.set_property('caps', gst.Caps('application/x-rtcp'))
+        if (receive_buffer_size):
+            udpsrc.set_property('buffer-size', receive_buffer_size)
+        self.latency = latency
+        if ('clock' in params):
+            (host, clock_port) = params['clock'].rsplit(':', 1)
+            self._start_clock(host, int(clock_port))
+            # Play out at the sender's timestamps plus a latency which
+            # is the same for every receiver
+            self.latency = int(params.get('latency', latency))
+            self.rtpbin.set_property('ntp-sync', True)
+        # No timestamp slaving in the jitter buffer
+        self.rtpbin.set_property('buffer-mode', 0)
+        self.rtpbin.set_property('latency', self.latency)
+        self.rtpbin.connect('pad-added', self._on_pad_added)
+        self.rtpbin.connect('element-added', self._on_element_added)
+        # Packets in and out of the session manager tell us how many
+        # the jitter buffer has dropped, as late or duplicate
+        udpsrc.get_pad('src').add_buffer_probe(self._on_packet_in)
+        self.depay.get_pad('sink').add_buffer_probe(self._on_packet_out)
+        self.add_many(udpsrc, rtcpsrc, self.rtpbin, self.depay, *decoders)
+        if ('nack' in params and 'sockfd' in params):
+            # NACKs are sent from the receive socket, so that the
+            # sender knows where to retransmit lost packets to
+            (host, nack_port) = params['nack'].rsplit(':', 1)
+            self.nack_addr = (host, int(nack_port))
+            self.nack_sock = socket.fromfd(int(params['sockfd']),
+                                           socket.AF_INET, socket.SOCK_DGRAM)
+            self.nack_ssrc = random.getrandbits(32)
+            # Packets recovered after the jitter buffer has given up on
+            # them are of no use, so count those as lost
+            self.loss = LossTracker(self.latency / 1000.0)
+        udpsrc.link_pads('src', self.rtpbin, 'recv_rtp_sink_0')
+        rtcpsrc.link_pads('src', self.rtpbin, 'recv_rtcp_sink_0')
+        if ('rtcp' in params):
+            (host, rtcp_port) = params['rtcp'].rsplit(':', 1)
+            rtcpsink = gst.element_factory_make('udpsink')
+            rtcpsink.set_property('host', host)
+            rtcpsink.set_property('port', int(rtcp_port))
+            rtcpsink.set_property('sync', False)
+            rtcpsink.set_property('async', False)
+            self.add(rtcpsink)
+            self.rtpbin.link_pads('send_rtcp_src_0', rtcpsink, 'sink')
+        gst.element_link_many(self.depay, *decoders)
+        pad = decoders[-1].get_pad('src')
         ghost_pad = gst.GhostPad('src', pad)
         self.add_pad(ghost_pad)
 
+    def _on_pad_added(self, rtpbin, pad):
+        # The session manager adds a pad for the sender once its
+        # first packet has arrived.  A new sender replaces any
+        # previous one, e.g., when a relay starts or stops relaying.
+        if (pad.get_name().startswith('recv_rtp_src_')):
+            sink = self.depay.get_pad('sink')
+            peer = sink.get_peer()
+            if (peer is not None):
+                peer.unlink(sink)
+            pad.link(sink)
+
+    def _on_element_added(self, rtpbin, element):
+        # The session manager creates a jitter buffer per sender
+        if (element.get_factory().get_name() == 'gstrtpjitterbuffer'):
+            element.set_property('drop-on-latency', drop_on_latency)
+
+    def _start_clock(self, host, port):
+        self.clock = gst.NetClientClock('rtpclock', host, port, 0)
+        # Requests of our own measure how far the slaved clock is from
+        # the sender's, i.e., the synchronization error
+        self.clock_addr = (host, port)
+        self.clock_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.clock_sock.setblocking(False)
+        self.clock_tags = [
+            gobject.io_add_watch(self.clock_sock.fileno(), gobject.IO_IN,
+                                 self._on_clock_reply),
+            gobject.timeout_add(int(sync_check_period * 1000),
+                                self._request_clock),
+        ]
+
+    def _stop_clock(self):
+        for tag in self.clock_tags:
+            gobject.source_remove(tag)
+        self.clock_tags = []
+        self.clock_sock.close()
+
+    def _request_clock(self):
+        try:
+            self.clock_sock.sendto(
+                NET_TIME_PACKET.pack(self.clock.get_time(), 0), self.clock_addr)
+        except socket.error as e:
+            logger.debug('Failed to request RTP clock time: %s', e)
+        return True
+
+    def _on_clock_reply(self, fd, condition):
+        try:
+            data = self.clock_sock.recv(NET_TIME_PACKET.size)
+            (sent, remote) = NET_TIME_PACKET.unpack(data)
+        except (socket.error, struct.error):
+            return True
+        now = self.clock.get_time()
+        # The sender read its clock half way through the round trip
+        self.sync_error = (remote - (sent + now) / 2.0) / gst.MSECOND
+        self.clock_round_trip = (now - sent) / float(gst.MSECOND)
+        return True
+
+    def do_provide_clock(self):
+        # Pipelines use the clock of their most upstream provider, so
+        # this slaves the whole pipeline to the sender's clock
+        return self.clock
+
+    def do_change_state(self, transition):
+        if (transition == gst.STATE_CHANGE_READY_TO_NULL and self.clock):
+            self._stop_clock()
+        return gst.Bin.do_change_state(self, transition)
+
+    def _measure_latency(self):
+        """Returns the latency (ms) reported upstream of the source pad"""
+        query = gst.query_new_latency()
+        # Querying the bin itself only folds the latency of its sink
+        # children, of which it has none, whereas the pad's query
+        # travels upstream through the jitter buffer
+        if (not self.get_pad('src').query(query)):
+            return None
+        (live, min_latency, max_latency) = query.parse_latency()
+        return min_latency / float(gst.MSECOND)
+
+    def _on_packet_in(self, pad, buf):
+        self.packets_in += 1
+        if (relay is not None):
+            relay(buf.data)
+        if (self.loss):
+            lost = self.loss.received(rtp_seq(buf.data))
+            if (lost):
+                media_ssrc = struct.unpack(b'!I', buf.data[8:12])[0]
+                try:
+                    self.nack_sock.sendto(
+                        encode_nack(self.nack_ssrc, media_ssrc, lost),
+                        self.nack_addr)
+                except socket.error as e:
+                    logger.debug('Failed to send NACK: %s', e)
+        return True
+
+    def _on_packet_out(self, pad, buf):
+        self.packets_out += 1
+        return True
+
+    def get_stats(self):
+        """
+        Returns a dictionary of reception statistics for the stream
+        being received: packets received and lost, interarrival jitter
+        (ms), packets dropped or still held by the jitter buffer, the
+        configured and measured latency (ms), when retransmission is
+        in use, packets requested again, recovered and lost, and when
+        synchronized, the offset of our clock from the sender's clock
+        and the round trip time (ms) of the last measurement
+        """
+        stats = {'packets_in': self.packets_in,
+                 'packets_out': self.packets_out,
+                 'jitterbuffer_drops': self.packets_in - self.packets_out,
+                 'configured_latency': self.latency}
+        if (self.sync_error is not None):
+            stats['sync_error'] = self.sync_error
+            stats['clock_round_trip'] = self.clock_round_trip
+        if (self.loss):
+            stats['retransmission_requested'] = self.loss.requested
+            stats['retransmission_recovered'] = self.loss.recovered
+            stats['retransmission_lost'] = self.loss.lost
+        if (self.rtpbin is None):
+            return stats
+        measured = self._measure_latency()
+        if (measured is not None):
+            stats['latency'] = measured
+        session = self.rtpbin.emit('get-internal-session', 0)
+        if (session is None):
+            return stats
+        for source in session.get_property('sources'):
+            s = source.get_property('stats')
+            if (s['internal'] or not s['is-sender']):
+                continue
+            clock_rate = s['clock-rate'] if s['clock-rate'] > 0 else 90000
+            stats['packets_received'] = s['packets-received']
+            stats['packets_lost'] = s['packets-lost']
+            stats['jitter'] = s['jitter'] * 1000.0 / clock_rate
+        return stats
+
     def set_property(self, name, value):
         if name == 'uri':
             self.do_set_uri(value)
@@ -66,8 +365,9 @@ class RTPSource(gst.Bin, gst.URIHandler):
         if not uri.startswith('rtp://'):
             return False
         self.uri = uri
-        port = RTPSource._parse_uri(uri)
-        self._launch_rtp_bin(port)
+        (group, port, params) = RTPSource._parse_uri(uri)
+        self._launch_rtp_bin(group, port, params)
+        instances.add(self)
         return True
 
     def do_get_uri(self):
@@ -0,0 +1,44 @@
+from __future__ import unicode_literals
+
+import threading
+
+
+class Metrics(object):
+    """
+    Thread-safe counters, gauges and timings keyed by dotted names,
+    e.g., "control.subscribe".  Counters only ever increase, gauges
+    hold the last value set and timings keep a count, total and
+    maximum of every value observed.
+    """
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + n
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.values[name + '.count'] = self.values.get(name + '.count', 0) + 1
+            self.values[name + '.total'] = self.values.get(name + '.total', 0) + value
+            self.values[name + '.max'] = max(self.values.get(name + '.max', 0), value)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+
+def format_stats(stats):
+    """Formats a dictionary of statistics as space separated key=value pairs"""
+    values = []
+    for key in sorted(stats.keys()):
+        value = stats[key]
+        if (isinstance(value, float)):
+            value = '%.3f' % value
+        values.append('%s=%s' % (key, value))
+    return ' '.join(values)
@@ -0,0 +1,151 @@
+from __future__ import unicode_literals
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import pygst
+pygst.require('0.10')
+import gst  # noqa
+import gobject
+
+from . import sink
+
+logger = logging.getLogger(__name__)
+
+
+class RtpEncoderWorker(object):
+    """
+    Encoding worker process, run as ``python -m mopidy_rtp.worker``
+    by :class:`sink.RtpWorkerSink`.  Raw audio is read from the shared
+    memory socket ``socket_path`` and fed to a :class:`sink.RtpSink`,
+    which encodes, payloads and fans it out exactly as it would inside
+    Mopidy.  Commands are read from stdin, one per line:
+    * ADD <host> <port> <rtcp_port> - starts streaming to a destination
+    * REMOVE <host> <port> - stops streaming to a destination
+    * FAST_JOIN <host> <port> - sends a fast join burst to a destination
+    and the negotiated RTP caps and the sink's counters are reported
+    on stdout as "CAPS <caps>" and "STATS <json>" lines.  The worker
+    exits when stdin is closed, i.e., when Mopidy goes away.
+    """
+    report_period = 1.0
+    retry_delay = 1.0
+
+    def __init__(self, socket_path):
+        self.loop = gobject.MainLoop()
+        self.pipeline = gst.Pipeline()
+        src = gst.element_factory_make('shmsrc')
+        src.set_property('socket-path', socket_path)
+        src.set_property('is-live', True)
+        src.set_property('do-timestamp', True)
+        capsfilter = gst.element_factory_make('capsfilter')
+        capsfilter.set_property('caps', gst.Caps(sink.WORKER_CAPS))
+        self.sink = sink.RtpSink()
+        self.pipeline.add(src, capsfilter, self.sink)
+        gst.element_link_many(src, capsfilter, self.sink)
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message::error', self._on_error)
+        self.caps = None
+        self.buffer = b''
+        self.retry_tag = None
+        gobject.io_add_watch(sys.stdin.fileno(),
+                             gobject.IO_IN | gobject.IO_ERR | gobject.IO_HUP,
+                             self._on_command)
+        gobject.timeout_add(int(self.report_period * 1000), self._report)
+
+    def _on_error(self, bus, message):
+        # Most likely Mopidy's end of the shared memory socket is not
+        # open yet, or has gone away while its pipeline is stopped
+        (error, debug) = message.parse_error()
+        logger.debug('RTP worker pipeline error: %s', error)
+        self.pipeline.set_state(gst.STATE_NULL)
+        if (self.retry_tag is None):
+            self.retry_tag = gobject.timeout_add(
+                int(self.retry_delay * 1000), self._start)
+
+    def _start(self):
+        self.retry_tag = None
+        self.pipeline.set_state(gst.STATE_PLAYING)
+        return False
+
+    def _on_command(self, fd, condition):
+        data = os.read(fd, 4096)
+        if (not data):
+            self.loop.quit()
+            return False
+        self.buffer += data
+        while (b'\n' in self.buffer):
+            (line, self.buffer) = self.buffer.split(b'\n', 1)
+            tokens = line.decode('utf-8').split(' ')
+            try:
+                if (tokens[0] == 'ADD' and len(tokens) == 4):
+                    self.sink.add(tokens[1], int(tokens[2]), int(tokens[3]))
+                elif (tokens[0] == 'REMOVE' and len(tokens) == 3):
+                    self.sink.remove(tokens[1], int(tokens[2]))
+                elif (tokens[0] == 'FAST_JOIN' and len(tokens) == 3):
+                    self.sink.fast_join(tokens[1], int(tokens[2]))
+                else:
+                    logger.warning('RTP worker ignoring command: %s', line)
+            except ValueError:
+                logger.warning('RTP worker ignoring command: %s', line)
+        return True
+
+    def _send(self, line):
+        sys.stdout.write(line.encode('utf-8') + b'\n')
+        sys.stdout.flush()
+
+    def _report(self):
+        if (self.sink.caps != self.caps):
+            self.caps = self.sink.caps
+            self._send('CAPS ' + self.caps)
+        stats = {
+            'bytes_sent': self.sink.bytes_sent,
+            'counters': self.sink.get_counters(),
+            'stats': self.sink.get_stats(),
+            # JSON objects are keyed by strings only
+            'drops': [[host, port, drops] for ((host, port), drops)
+                      in self.sink.get_drops().items()],
+        }
+        self._send('STATS ' + json.dumps(stats))
+        return True
+
+    def run(self):
+        self._start()
+        try:
+            self.loop.run()
+        finally:
+            self.pipeline.set_state(gst.STATE_NULL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mopidy RTP encoding worker')
+    parser.add_argument('--socket', required=True)
+    parser.add_argument('--encoder', default=sink.encoder)
+    parser.add_argument('--payload', default=sink.payload_mode)
+    parser.add_argument('--fanout', default=sink.fanout)
+    parser.add_argument('--rtcp-port', type=int, default=sink.rtcp_port)
+    parser.add_argument('--queue-size', type=int, default=sink.queue_size)
+    parser.add_argument('--drop-policy', default=sink.drop_policy)
+    parser.add_argument('--fast-join', type=int, default=0)
+    parser.add_argument('--clock-port', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='RTP worker %(levelname)s %(message)s')
+    sink.encoder = args.encoder
+    sink.payload_mode = args.payload
+    sink.fanout = args.fanout
+    sink.rtcp_port = args.rtcp_port
+    sink.queue_size = args.queue_size
+    sink.drop_policy = args.drop_policy
+    sink.fast_join_packets = args.fast_join
+    sink.clock_port = args.clock_port
+    gobject.threads_init()
+    RtpEncoderWorker(args.socket).run()
+
+
+if __name__ == '__main__':
+    main()
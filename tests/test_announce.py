@@ -0,0 +1,25 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from mopidy_rtp.announce import AnnounceScheduler
+
+
+class AnnounceSchedulerTest(unittest.TestCase):
+
+    def test_burst_then_backoff(self):
+        scheduler = AnnounceScheduler(1, 30, 3, 0)
+        intervals = [scheduler.next_interval() for _ in range(8)]
+        self.assertEqual(intervals, [1, 1, 1, 2, 4, 8, 16, 30])
+
+    def test_reset_restarts_burst(self):
+        scheduler = AnnounceScheduler(1, 30, 2, 0)
+        for _ in range(5):
+            scheduler.next_interval()
+        scheduler.reset()
+        self.assertEqual(scheduler.next_interval(), 1)
+
+    def test_jitter_bounds(self):
+        scheduler = AnnounceScheduler(10, 10, 1, 0.1)
+        for _ in range(50):
+            self.assertTrue(9 <= scheduler.next_interval() <= 11)
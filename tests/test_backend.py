@@ -0,0 +1,93 @@
+from __future__ import unicode_literals
+
+import unittest
+
+import mock
+
+from mopidy_rtp.actor import RtpBackend
+
+NOW = 1000.0
+
+
+def call(name, backend):
+    # The methods only touch the backend's state, which is mocked
+    # rather than starting an actor with a real sink
+    return RtpBackend.__dict__[name](backend)
+
+
+class ExpireLeasesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = mock.Mock()
+        self.backend.subscribers = {}
+        self.backend.multicast_listeners = {}
+
+    @mock.patch('time.time', return_value=NOW)
+    def test_expired_subscriber_is_stopped(self, time):
+        self.backend.subscribers = {('10.0.0.2', 7000): NOW - 1,
+                                    ('10.0.0.3', 7000): NOW + 1}
+        self.assertTrue(call('_expire_leases', self.backend))
+        self.backend._stop_rtp_session.assert_called_once_with(
+            '10.0.0.2', 7000)
+
+    @mock.patch('time.time', return_value=NOW)
+    def test_expired_multicast_listener_leaves(self, time):
+        self.backend.multicast_listeners = {'10.0.0.2': NOW - 1,
+                                            '10.0.0.3': NOW + 1}
+        self.assertTrue(call('_expire_leases', self.backend))
+        self.backend._leave_multicast.assert_called_once_with('10.0.0.2')
+        self.assertFalse(self.backend._stop_rtp_session.called)
+
+    @mock.patch('time.time', return_value=NOW)
+    def test_nothing_expires_early(self, time):
+        self.backend.subscribers = {('10.0.0.2', 7000): NOW}
+        self.backend.multicast_listeners = {'10.0.0.3': NOW}
+        call('_expire_leases', self.backend)
+        self.assertFalse(self.backend._stop_rtp_session.called)
+        self.assertFalse(self.backend._leave_multicast.called)
+
+
+class EvictSlowSubscribersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = mock.Mock()
+        self.backend.config = {'subscriber_max_drops': 10}
+        self.backend.eviction_strikes = 2
+        self.backend.eviction_holdoff = 60.0
+        self.backend.subscribers = {('10.0.0.2', 7000): NOW + 30}
+        self.backend.drop_samples = {}
+        self.backend.evicted = {}
+
+    def evict(self, drops):
+        self.backend.sink.get_drops.return_value = drops
+        with mock.patch('time.time', return_value=NOW):
+            self.assertTrue(call('_evict_slow_subscribers', self.backend))
+
+    def test_persistently_slow_subscriber_is_evicted(self):
+        dest = ('10.0.0.2', 7000)
+        self.evict({dest: 11})
+        self.assertEqual(self.backend.drop_samples, {dest: (11, 1)})
+        self.assertFalse(self.backend._stop_rtp_session.called)
+        self.evict({dest: 22})
+        self.backend._stop_rtp_session.assert_called_once_with(*dest)
+        self.backend.metrics.incr.assert_called_once_with('subscribers.evicted')
+        self.assertEqual(self.backend.evicted, {dest: NOW + 60.0})
+        self.assertEqual(self.backend.drop_samples, {})
+
+    def test_strikes_reset_once_subscriber_keeps_up(self):
+        dest = ('10.0.0.2', 7000)
+        self.evict({dest: 11})
+        self.evict({dest: 15})
+        self.assertEqual(self.backend.drop_samples, {dest: (15, 0)})
+        self.evict({dest: 26})
+        self.assertFalse(self.backend._stop_rtp_session.called)
+
+    def test_drops_of_unknown_destinations_are_ignored(self):
+        self.evict({('10.0.0.9', 7000): 100})
+        self.assertEqual(self.backend.drop_samples, {})
+
+    def test_holdoff_expires(self):
+        self.backend.evicted = {('10.0.0.2', 7000): NOW - 1,
+                                ('10.0.0.3', 7000): NOW + 1}
+        self.evict({})
+        self.assertEqual(self.backend.evicted, {('10.0.0.3', 7000): NOW + 1})
@@ -0,0 +1,56 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from mopidy_rtp import beacon
+
+
+class BeaconTest(unittest.TestCase):
+
+    def make_beacon(self, **kwargs):
+        values = dict(name='Kitchen', port=7128, subscribers=2,
+                      max_subscribers=8, codec='flacenc', caps_id=1234,
+                      bitrate=900, load=12)
+        values.update(kwargs)
+        return beacon.Beacon(**values)
+
+    def test_announce_round_trip(self):
+        info = self.make_beacon(flags=beacon.FLAG_MULTICAST)
+        (msg_type, decoded) = beacon.decode(beacon.encode_announce(info))
+        self.assertEqual(msg_type, beacon.TYPE_ANNOUNCE)
+        self.assertEqual(decoded, info)
+        self.assertTrue(decoded.multicast)
+        self.assertFalse(decoded.relay)
+
+    def test_relay_round_trip(self):
+        info = self.make_beacon(flags=beacon.FLAG_RELAY, origin='10.0.0.1')
+        (msg_type, decoded) = beacon.decode(beacon.encode_announce(info))
+        self.assertTrue(decoded.relay)
+        self.assertEqual(decoded.origin, '10.0.0.1')
+
+    def test_query_and_bye(self):
+        self.assertEqual(beacon.decode(beacon.encode_query()),
+                         (beacon.TYPE_QUERY, None))
+        self.assertEqual(beacon.decode(beacon.encode_bye()),
+                         (beacon.TYPE_BYE, None))
+
+    def test_legacy_beacon_is_station_name(self):
+        (msg_type, decoded) = beacon.decode(b'Mopidy RTP Service')
+        self.assertEqual(msg_type, beacon.TYPE_ANNOUNCE)
+        self.assertEqual(decoded.name, 'Mopidy RTP Service')
+        self.assertIsNone(decoded.port)
+        self.assertFalse(decoded.full)
+
+    def test_appended_fields_are_ignored(self):
+        info = self.make_beacon()
+        data = beacon.encode_announce(info) + b'\x00\x01\x02'
+        self.assertEqual(beacon.decode(data)[1], info)
+
+    def test_truncated_beacon_raises(self):
+        data = beacon.encode_announce(self.make_beacon())
+        for length in (len(beacon.MAGIC) + 2, len(data) - 1):
+            self.assertRaises(ValueError, beacon.decode, data[:length])
+
+    def test_full(self):
+        self.assertTrue(self.make_beacon(subscribers=8).full)
+        self.assertFalse(self.make_beacon(subscribers=7).full)
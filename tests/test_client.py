@@ -0,0 +1,153 @@
+from __future__ import unicode_literals
+
+import socket
+import threading
+import time
+import unittest
+
+import mock
+
+from mopidy_rtp.client import (
+    RtpCommandError, RtpConnectionError, RtpControlClient, RtpTimeoutError)
+
+GREETING = b'OK RTP 0.0.2\n'
+
+
+class RtpControlClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.peers = []
+        patcher = mock.patch('socket.create_connection',
+                             side_effect=self._connect)
+        self.create_connection = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = RtpControlClient('station', 6000, 0.2)
+        self.addCleanup(self.client.close)
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.close()
+
+    def _connect(self, address, timeout):
+        (sock, peer) = socket.socketpair()
+        self.peers.append(peer)
+        reply = self.replies.pop(0)
+        if (reply is None):
+            # The station goes away straight after greeting
+            peer.sendall(GREETING)
+            peer.close()
+        else:
+            peer.sendall(GREETING + reply)
+        return sock
+
+    def _received(self, peer):
+        peer.setblocking(False)
+        try:
+            return peer.recv(4096)
+        finally:
+            peer.setblocking(True)
+
+    def test_command_returns_params(self):
+        self.replies = [b'ERROR_OK caps=x decoder=flacdec\n']
+        self.assertEqual(self.client.command('CAPS'),
+                         {'caps': 'x', 'decoder': 'flacdec'})
+        self.assertEqual(self._received(self.peers[0]), b'CAPS\n')
+        self.create_connection.assert_called_once_with(('station', 6000), 0.2)
+
+    def test_connection_is_reused(self):
+        self.replies = [b'ERROR_OK\n']
+        self.client.command('STATUS')
+        self.peers[0].sendall(b'ERROR_OK\n')
+        self.client.command('STATUS')
+        self.assertEqual(self.create_connection.call_count, 1)
+
+    def test_crlf_is_stripped(self):
+        self.replies = [b'ERROR_OK lease=30\r\n']
+        self.assertEqual(self.client.command('RENEW 7000'), {'lease': '30'})
+
+    def test_error_code_is_raised(self):
+        self.replies = [b'ERROR_UNRECOGNIZED_COMMAND\n']
+        try:
+            self.client.command('JOIN')
+        except RtpCommandError as e:
+            self.assertEqual(e.code, 'ERROR_UNRECOGNIZED_COMMAND')
+        else:
+            self.fail('RtpCommandError not raised')
+
+    def test_dropped_connection_is_retried_once(self):
+        self.replies = [b'ERROR_OK\n', b'ERROR_OK lease=30\n']
+        self.client.command('STATUS')
+        # The station times out the idle connection
+        self.peers[0].close()
+        self.assertEqual(self.client.command('RENEW 7000'), {'lease': '30'})
+        self.assertEqual(self.create_connection.call_count, 2)
+        self.assertEqual(self._received(self.peers[1]), b'RENEW 7000\n')
+
+    def test_retry_failure_is_raised(self):
+        self.replies = [b'ERROR_OK\n']
+        self.client.command('STATUS')
+        self.peers[0].close()
+        self.create_connection.side_effect = socket.error('refused')
+        self.assertRaises(RtpConnectionError, self.client.command, 'STATUS')
+        self.assertIsNone(self.client.sock)
+
+    def test_fresh_connection_is_not_retried(self):
+        self.replies = [None]
+        self.assertRaises(RtpConnectionError, self.client.command, 'STATUS')
+        self.assertEqual(self.create_connection.call_count, 1)
+
+    def test_connect_timeout(self):
+        self.create_connection.side_effect = socket.timeout()
+        self.assertRaises(RtpTimeoutError, self.client.command, 'STATUS')
+
+    def test_connect_error(self):
+        self.create_connection.side_effect = socket.error('unreachable')
+        self.assertRaises(RtpConnectionError, self.client.command, 'STATUS')
+
+    def test_missing_greeting_times_out(self):
+        self.create_connection.side_effect = None
+        (sock, peer) = socket.socketpair()
+        self.peers.append(peer)
+        self.create_connection.return_value = sock
+        start = time.time()
+        self.assertRaises(RtpTimeoutError, self.client.command, 'STATUS')
+        self.assertLess(time.time() - start, 1.0)
+        self.assertIsNone(self.client.sock)
+
+    def test_missing_response_times_out_within_deadline(self):
+        self.replies = [b'']
+        start = time.time()
+        self.assertRaises(RtpTimeoutError, self.client.command, 'STATUS')
+        self.assertLess(time.time() - start, 1.0)
+        self.assertIsNone(self.client.sock)
+
+    def test_trickled_response_is_bounded_by_deadline(self):
+        self.replies = [b'']
+        done = threading.Event()
+
+        def trickle(peer):
+            # Each byte arrives well within the timeout, the line never
+            try:
+                while (not done.wait(0.05)):
+                    peer.sendall(b'x')
+            except socket.error:
+                pass
+
+        thread = None
+        start = time.time()
+        try:
+            self.client._connect()
+            thread = threading.Thread(target=trickle, args=(self.peers[0],))
+            thread.start()
+            self.assertRaises(RtpTimeoutError, self.client.command, 'STATUS')
+        finally:
+            done.set()
+            if (thread is not None):
+                thread.join()
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_overlong_response_is_cut_off(self):
+        self.client.max_line = 64
+        self.replies = [b'x' * 100]
+        self.assertRaises(RtpTimeoutError, self.client.command, 'STATUS')
+        self.assertIsNone(self.client.sock)
@@ -0,0 +1,94 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from mopidy_rtp.beacon import Beacon
+from mopidy_rtp.registry import StationRegistry
+
+
+class StationRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = StationRegistry(10)
+        self.changes = []
+        self.registry.add_listener(lambda: self.changes.append(True))
+
+    def test_update_adds_station(self):
+        station = self.registry.update('1.2.3.4', Beacon('One'), now=100)
+        self.assertIn('1.2.3.4', self.registry)
+        self.assertEqual(station.name, 'One')
+        self.assertEqual(station.last_seen, 100)
+        self.assertEqual(len(self.changes), 1)
+
+    def test_update_with_same_info_does_not_notify(self):
+        self.registry.update('1.2.3.4', Beacon('One'), now=100)
+        self.registry.update('1.2.3.4', Beacon('One'), now=105)
+        self.assertEqual(self.registry.get('1.2.3.4').last_seen, 105)
+        self.assertEqual(len(self.changes), 1)
+
+    def test_update_with_changed_info_notifies(self):
+        self.registry.update('1.2.3.4', Beacon('One'), now=100)
+        self.registry.update('1.2.3.4', Beacon('Two'), now=105)
+        self.assertEqual(self.registry.get('1.2.3.4').name, 'Two')
+        self.assertEqual(len(self.changes), 2)
+
+    def test_update_with_new_bitrate_or_load_does_not_notify(self):
+        self.registry.update('1.2.3.4', Beacon('One', bitrate=900, load=10),
+                             now=100)
+        self.registry.update('1.2.3.4', Beacon('One', bitrate=850, load=20),
+                             now=105)
+        self.assertEqual(self.registry.get('1.2.3.4').info.bitrate, 850)
+        self.assertEqual(len(self.changes), 1)
+
+    def test_update_with_new_load_quarter_notifies(self):
+        self.registry.update('1.2.3.4', Beacon('One', load=10), now=100)
+        self.registry.update('1.2.3.4', Beacon('One', load=30), now=105)
+        self.assertEqual(len(self.changes), 2)
+
+    def test_update_with_full_station_notifies(self):
+        self.registry.update('1.2.3.4', Beacon('One', subscribers=7,
+                                               max_subscribers=8), now=100)
+        self.registry.update('1.2.3.4', Beacon('One', subscribers=8,
+                                               max_subscribers=8), now=105)
+        self.assertEqual(len(self.changes), 2)
+
+    def test_values(self):
+        self.registry.update('1.2.3.4', Beacon('One'), now=100)
+        self.registry.update('1.2.3.5', Beacon('Two'), now=100)
+        self.assertEqual(sorted(s.name for s in self.registry.values()),
+                         ['One', 'Two'])
+
+    def test_remove(self):
+        self.registry.update('1.2.3.4', Beacon('One'), now=100)
+        self.registry.remove('1.2.3.4')
+        self.assertNotIn('1.2.3.4', self.registry)
+        self.assertEqual(len(self.changes), 2)
+
+    def test_remove_unknown_does_not_notify(self):
+        self.registry.remove('1.2.3.4')
+        self.assertEqual(self.changes, [])
+
+    def test_expire_removes_only_stale_stations(self):
+        self.registry.update('1.2.3.4', Beacon('One'), now=100)
+        self.registry.update('1.2.3.5', Beacon('Two'), now=105)
+        self.registry.expire(now=112)
+        self.assertNotIn('1.2.3.4', self.registry)
+        self.assertIn('1.2.3.5', self.registry)
+        self.assertEqual(len(self.changes), 3)
+
+    def test_expire_uses_last_seen_order(self):
+        self.registry.update('1.2.3.4', Beacon('One'), now=100)
+        self.registry.update('1.2.3.5', Beacon('Two'), now=101)
+        # Seeing the oldest station again moves it to the newest end
+        self.registry.update('1.2.3.4', Beacon('One'), now=108)
+        self.registry.expire(now=112)
+        self.assertIn('1.2.3.4', self.registry)
+        self.assertNotIn('1.2.3.5', self.registry)
+
+    def test_clear(self):
+        self.registry.update('1.2.3.4', Beacon('One'), now=100)
+        self.registry.clear()
+        self.assertEqual(len(self.registry), 0)
+        self.assertEqual(len(self.changes), 2)
+        self.registry.clear()
+        self.assertEqual(len(self.changes), 2)
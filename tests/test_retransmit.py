@@ -0,0 +1,100 @@
+from __future__ import unicode_literals
+
+import struct
+import unittest
+
+from mopidy_rtp import retransmit
+
+
+def packet(seq, marker=False):
+    return struct.pack(b'!BBHII', 0x80, 0x80 if marker else 0, seq, 0, 1)
+
+
+class NackTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        seqs = [10, 11, 14, 26, 27, 100]
+        data = retransmit.encode_nack(1, 2, seqs)
+        self.assertEqual(retransmit.decode_nack(data), seqs)
+
+    def test_round_trip_across_wrap(self):
+        seqs = [65534, 65535, 0, 1]
+        data = retransmit.encode_nack(1, 2, seqs)
+        self.assertEqual(retransmit.decode_nack(data), seqs)
+
+    def test_bitmask_packs_nearby_seqs(self):
+        data = retransmit.encode_nack(1, 2, list(range(10, 27)))
+        self.assertEqual(len(data), retransmit.NACK_HEADER.size +
+                         retransmit.NACK_FCI.size)
+
+    def test_decode_rejects_other_packets(self):
+        self.assertRaises(ValueError, retransmit.decode_nack, b'')
+        self.assertRaises(ValueError, retransmit.decode_nack,
+                          packet(1) + b'\x00' * 4)
+
+
+class PacketHistoryTest(unittest.TestCase):
+
+    def test_get(self):
+        history = retransmit.PacketHistory(4)
+        for seq in range(6):
+            history.add(packet(seq))
+        self.assertIsNone(history.get(1))
+        self.assertEqual(history.get(5), packet(5))
+
+    def test_recent(self):
+        history = retransmit.PacketHistory(4)
+        for seq in range(6):
+            history.add(packet(seq))
+        self.assertEqual(history.recent(2), [packet(4), packet(5)])
+        self.assertEqual(history.recent(10),
+                         [packet(s) for s in range(2, 6)])
+
+    def test_recent_aligned(self):
+        history = retransmit.PacketHistory(8)
+        for seq in range(6):
+            history.add(packet(seq, marker=(seq == 2)))
+        self.assertEqual(history.recent(5, aligned=True),
+                         [packet(3), packet(4), packet(5)])
+        self.assertEqual(history.recent(2, aligned=True), [])
+
+    def test_clear(self):
+        history = retransmit.PacketHistory(4)
+        history.add(packet(1))
+        history.clear()
+        self.assertEqual(history.recent(4), [])
+
+
+class LossTrackerTest(unittest.TestCase):
+
+    def test_gap_is_reported(self):
+        tracker = retransmit.LossTracker(1.0)
+        self.assertEqual(tracker.received(10), [])
+        self.assertEqual(tracker.received(11), [])
+        self.assertEqual(tracker.received(14), [12, 13])
+        self.assertEqual(tracker.requested, 2)
+
+    def test_gap_across_wrap(self):
+        tracker = retransmit.LossTracker(1.0)
+        tracker.received(65534)
+        self.assertEqual(tracker.received(1), [65535, 0])
+
+    def test_late_packet_is_recovered(self):
+        tracker = retransmit.LossTracker(1.0)
+        tracker.received(10)
+        tracker.received(13)
+        self.assertEqual(tracker.received(11), [])
+        self.assertEqual(tracker.recovered, 1)
+
+    def test_expired_packet_is_lost(self):
+        tracker = retransmit.LossTracker(0)
+        tracker.received(10)
+        tracker.received(12)
+        tracker.received(13)
+        self.assertEqual(tracker.lost, 1)
+
+    def test_large_gap_is_a_restart(self):
+        tracker = retransmit.LossTracker(1.0)
+        tracker.received(10)
+        self.assertEqual(tracker.received(1000), [])
+        self.assertEqual(tracker.requested, 0)
@@ -0,0 +1,121 @@
+from __future__ import unicode_literals
+
+import errno
+import socket
+import time
+import unittest
+
+import mock
+
+from mopidy_rtp.server import RtpControlServer, _Connection
+
+
+class RtpControlServerTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('mopidy_rtp.server.gobject')
+        self.gobject = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('mopidy_rtp.server.handle_command',
+                             return_value=['ERROR_OK'])
+        self.handle_command = patcher.start()
+        self.addCleanup(patcher.stop)
+        # The listening socket plays no part in framing
+        self.server = RtpControlServer.__new__(RtpControlServer)
+        self.server.backend = mock.Mock()
+        self.server.timeout = 10
+        self.server.connections = {}
+        self.peers = []
+
+    def tearDown(self):
+        for conn in list(self.server.connections.values()):
+            self.server._close(conn)
+        for peer in self.peers:
+            peer.close()
+
+    def _connect(self, addr=('::ffff:10.0.0.2', 5000)):
+        (sock, peer) = socket.socketpair()
+        sock.setblocking(False)
+        peer.settimeout(1.0)
+        self.peers.append(peer)
+        conn = _Connection(sock, addr)
+        self.server.connections[sock.fileno()] = conn
+        return (conn, peer)
+
+    def _receive(self, conn, peer, data):
+        peer.sendall(data)
+        return self.server._on_readable(conn.sock.fileno(), None, conn)
+
+    def test_host_is_unmapped(self):
+        (conn, peer) = self._connect()
+        self.assertEqual(conn.host, '10.0.0.2')
+
+    def test_line_is_handled(self):
+        (conn, peer) = self._connect()
+        self.assertTrue(self._receive(conn, peer, b'STATUS\n'))
+        self.handle_command.assert_called_once_with(
+            self.server.backend, '10.0.0.2', 'STATUS')
+        self.assertEqual(peer.recv(4096), b'ERROR_OK\n')
+
+    def test_partial_line_is_buffered(self):
+        (conn, peer) = self._connect()
+        self.assertTrue(self._receive(conn, peer, b'SUBSCRIBE 70'))
+        self.assertFalse(self.handle_command.called)
+        self.assertTrue(self._receive(conn, peer, b'00\r\n'))
+        self.handle_command.assert_called_once_with(
+            self.server.backend, '10.0.0.2', 'SUBSCRIBE 7000')
+
+    def test_several_lines_are_handled_in_order(self):
+        (conn, peer) = self._connect()
+        self.assertTrue(self._receive(conn, peer, b'STATUS\nCAPS\nRENEW'))
+        self.assertEqual([c[0][2] for c in self.handle_command.call_args_list],
+                         ['STATUS', 'CAPS'])
+        self.assertEqual(conn.buffer, b'RENEW')
+
+    def test_overlong_line_closes_connection(self):
+        self.server.max_line = 16
+        (conn, peer) = self._connect()
+        self.assertFalse(self._receive(conn, peer, b'x' * 32))
+        self.assertIsNone(conn.sock)
+        self.assertEqual(self.server.connections, {})
+        self.assertFalse(self.handle_command.called)
+
+    def test_invalid_utf8_closes_connection(self):
+        (conn, peer) = self._connect()
+        self.assertFalse(self._receive(conn, peer, b'STATUS \xff\n'))
+        self.assertIsNone(conn.sock)
+        self.assertFalse(self.handle_command.called)
+
+    def test_eof_closes_connection(self):
+        (conn, peer) = self._connect()
+        conn.tags['in'] = 1
+        peer.shutdown(socket.SHUT_WR)
+        self.assertFalse(self.server._on_readable(conn.sock.fileno(), None,
+                                                  conn))
+        self.assertIsNone(conn.sock)
+        self.gobject.source_remove.assert_called_once_with(1)
+
+    def test_unread_output_closes_connection(self):
+        self.server.max_output = 64
+        (conn, peer) = self._connect()
+        # Responses the client has not read yet
+        conn.output = b'x' * 60
+        self.server._send(conn, ['ERROR_OK'])
+        self.assertIsNone(conn.sock)
+
+    def test_blocked_output_waits_for_writable(self):
+        (conn, peer) = self._connect()
+        conn.sock = mock.Mock(wraps=conn.sock)
+        conn.sock.send.side_effect = socket.error(errno.EAGAIN, 'EAGAIN')
+        self.server._send(conn, ['ERROR_OK'])
+        self.assertEqual(conn.output, b'ERROR_OK\n')
+        self.assertIn('out', conn.tags)
+
+    def test_idle_connection_expires(self):
+        (idle, _) = self._connect()
+        (active, _) = self._connect()
+        idle.last_active = time.time() - 20
+        self.assertTrue(self.server._expire())
+        self.assertIsNone(idle.sock)
+        self.assertIsNotNone(active.sock)
+        self.assertEqual(list(self.server.connections.values()), [active])
@@ -0,0 +1,85 @@
+from __future__ import unicode_literals
+
+import unittest
+
+import mock
+
+from mopidy_rtp.session import _destinations, handle_command
+
+
+class DestinationsTest(unittest.TestCase):
+
+    def test_single_port(self):
+        self.assertEqual(_destinations(['SUBSCRIBE', '7000']), [(7000, None)])
+
+    def test_single_port_with_rtcp_port(self):
+        self.assertEqual(_destinations(['SUBSCRIBE', '7000', '7002']),
+                         [(7000, 7002)])
+
+    def test_batched(self):
+        self.assertEqual(
+            _destinations(['SUBSCRIBE', '7000:7001', '7002:7003']),
+            [(7000, 7001), (7002, 7003)])
+
+    def test_single_batched_entry(self):
+        self.assertEqual(_destinations(['SUBSCRIBE', '7000:7001']),
+                         [(7000, 7001)])
+
+    def test_bare_port_list_is_rejected(self):
+        self.assertRaises(ValueError, _destinations,
+                          ['SUBSCRIBE', '7000', '7002', '7004'])
+
+    def test_mixed_forms_are_rejected(self):
+        self.assertRaises(ValueError, _destinations,
+                          ['SUBSCRIBE', '7000:7001', '7002'])
+
+    def test_malformed_port_is_rejected(self):
+        self.assertRaises(ValueError, _destinations, ['SUBSCRIBE', 'x'])
+        self.assertRaises(ValueError, _destinations, ['SUBSCRIBE', '7000:'])
+
+
+class HandleCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = mock.Mock()
+        self.backend.config = {'lease_time': 30}
+        self.backend._stream_params.return_value = 'rtcp=7128 payload=gst'
+        self.backend._start_rtp_session.return_value = True
+
+    def test_subscribe(self):
+        response = handle_command(self.backend, '1.2.3.4', 'SUBSCRIBE 7000 7002')
+        self.assertEqual(response, ['ERROR_OK lease=30 rtcp=7128 payload=gst'])
+        self.backend._start_rtp_session.assert_called_once_with(
+            '1.2.3.4', 7000, 7002)
+
+    def test_batched_subscribe_lists_ports(self):
+        self.backend._start_rtp_session.side_effect = [True, False]
+        response = handle_command(self.backend, '1.2.3.4',
+                                  'SUBSCRIBE 7000:7001 7002:7003')
+        self.assertEqual(response, ['ERROR_OK lease=30 rtcp=7128 payload=gst '
+                                    'subscribed=7000 rejected=7002'])
+
+    def test_subscriber_limit(self):
+        self.backend._start_rtp_session.return_value = False
+        response = handle_command(self.backend, '1.2.3.4', 'SUBSCRIBE 7000')
+        self.assertEqual(response, ['ERROR_SUBSCRIBER_LIMIT_REACHED'])
+
+    def test_renew_lists_expired_ports(self):
+        self.backend._renew_rtp_session.side_effect = [True, False]
+        response = handle_command(self.backend, '1.2.3.4', 'RENEW 7000 7002')
+        self.assertEqual(response, ['ERROR_OK lease=30 expired=7002'])
+
+    def test_invalid_argument(self):
+        response = handle_command(self.backend, '1.2.3.4', 'SUBSCRIBE x')
+        self.assertEqual(response, ['ERROR_INVALID_ARGUMENT'])
+
+    def test_unrecognized_command(self):
+        response = handle_command(self.backend, '1.2.3.4', 'PLAY')
+        self.assertEqual(response, ['ERROR_UNRECOGNIZED_COMMAND'])
+        self.backend.metrics.observe.assert_called_once_with(
+            'control.unrecognized', mock.ANY)
+
+    def test_unexpected_failure_is_answered(self):
+        self.backend._start_rtp_session.side_effect = RuntimeError
+        response = handle_command(self.backend, '1.2.3.4', 'SUBSCRIBE 7000')
+        self.assertEqual(response, ['ERROR_INTERNAL'])